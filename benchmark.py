@@ -0,0 +1,981 @@
+"""Offline end-to-end benchmark for the QMS worker.
+
+Runs script.py as a subprocess for every main() option against synthetic QMS
+repositories of increasing size. GitHub and OpenAI are replaced by local fake
+servers, so no network access or credentials are needed. Wall time, API calls
+and bytes moved are reported per scenario and compared against a baseline:
+
+    python benchmark.py                     # run and compare
+    python benchmark.py --update-baseline   # run and store as new baseline
+    python benchmark.py --sizes 10,100 --llm-latency 0.2 --github-latency 0.05
+
+Exits with status 1 when a scenario regresses beyond the tolerances.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TARGET_REPO = "bench/qms"
+SECOND_REPO = "bench/qms-2"
+DOCS_REPO = "seespine-2022/qms-docs"
+CURRENT_REPO = "bench/product"
+CR_RECORD = "change-request-records/CR001-Existing_change.md"
+
+# Allowed growth over the baseline before a scenario counts as regressed
+TOLERANCES = {"seconds": 0.25, "github_calls": 0.0, "openai_calls": 0.0, "bytes": 0.10}
+
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def blob_sha(data):
+    return sha1(b"blob %d\0" % len(data) + data)
+
+
+class Traffic:
+    """Request and byte counters per API, shared by both fake servers."""
+
+    def __init__(self, fail_every=0):
+        self.lock = threading.Lock()
+        self.fail_every = fail_every
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {"github_calls": 0, "openai_calls": 0, "bytes": 0}
+            self.requests = 0
+
+    def should_fail(self):
+        """Every ``fail_every``-th request is answered with a rate-limit error.
+
+        Returns 0 for requests that go through, otherwise the failure count.
+        """
+        with self.lock:
+            self.requests += 1
+            if not self.fail_every or self.requests % self.fail_every:
+                return 0
+            return self.requests // self.fail_every
+
+    def record(self, api, bytes_moved):
+        with self.lock:
+            self.counts[f"{api}_calls"] += 1
+            self.counts["bytes"] += bytes_moved
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+# Synthetic QMS content
+def change_request_template():
+    sections = [
+        "1. Purpose",
+        "2. Change Request Information",
+        "3. Description of Change",
+        "4. Impact Assessment",
+        "5. Design Traceability Matrix Impact",
+        "6. Risk Impact",
+        "7. Significance",
+        "8. Verification and Validation",
+        "9. Training",
+        "10. Supporting Documentation",
+        "11. Revision Log",
+    ]
+    body = "# Change Request Form\n\n"
+    for title in sections:
+        body += f"## {title}\n\n| Field | Value |\n| --- | --- |\n| Item | TBD |\n\n"
+    return body
+
+
+def design_matrix(size):
+    return json.dumps(
+        {
+            "userNeeds": [
+                {
+                    "id": f"UN-{i}",
+                    "description": (
+                        f"User need {i}: battery charging at low temperature"
+                        if i == size // 2
+                        else f"User need {i} for component {i % 7}"
+                    ),
+                    "component": f"component-{i % 7}",
+                    "requirements": [
+                        {"reqId": f"REQ-{i}-{j}", "text": f"Requirement {j}"}
+                        for j in range(3)
+                    ],
+                }
+                for i in range(size)
+            ]
+        },
+        indent=2,
+    )
+
+
+def fmea(size):
+    return json.dumps(
+        {
+            "failureModes": [
+                {
+                    "id": f"FM-{i}",
+                    "component": f"component-{i % 7}",
+                    "failureMode": (
+                        f"Failure {i}: battery charging stops at low temperature"
+                        if i == size // 3
+                        else f"Failure {i} of component {i % 7}"
+                    ),
+                    "effect": "Degraded performance",
+                    "severity": 1 + i % 5,
+                    "probability": 1 + i % 3,
+                    "control": "Automatic testing",
+                }
+                for i in range(size)
+            ]
+        },
+        indent=2,
+    )
+
+
+def qms_files(size):
+    files = {
+        "change-requests/change-request-template.md": change_request_template(),
+        "design/design-matrix/design-matrix.json": design_matrix(size),
+        "risk/fmea/fmea.json": fmea(size),
+        CR_RECORD: change_request_template().replace("TBD", "Existing value"),
+    }
+    areas = ["sop", "design", "risk", "training", "software"]
+    for i in range(size):
+        area = areas[i % len(areas)]
+        files[f"{area}/doc-{i:04d}.md"] = (
+            f"# {area.title()} document {i}\n\n## Scope\n\nThis {area} document "
+            f"covers component {i % 7}.\n\n## Procedure\n\n"
+            + "Step of the procedure.\n" * 20
+        )
+    return {path: content.encode("utf-8") for path, content in files.items()}
+
+
+class GitRepo:
+    def __init__(self, full_name, files):
+        self.full_name = full_name
+        self.blobs = {}
+        self.trees = {}
+        self.commits = {}
+        self.branches = {"main": self.commit(self.tree(files), [], "Initial")}
+        self.pulls = {}
+        self.issues = {}
+
+    def tree(self, files):
+        entries = {}
+        for path, data in files.items():
+            sha = blob_sha(data)
+            self.blobs[sha] = data
+            entries[path] = sha
+        tree_sha = sha1(json.dumps(entries, sort_keys=True).encode())
+        self.trees[tree_sha] = entries
+        return tree_sha
+
+    def commit(self, tree_sha, parents, message):
+        sha = sha1(json.dumps([tree_sha, parents, message, time.time()]).encode())
+        self.commits[sha] = {"tree": tree_sha, "parents": parents, "message": message}
+        return sha
+
+    def files(self, ref):
+        commit_sha = self.branches.get(ref, ref)
+        return {
+            path: self.blobs[sha]
+            for path, sha in self.trees[self.commits[commit_sha]["tree"]].items()
+        }
+
+
+class FakeGitHub(BaseHTTPRequestHandler):
+    """The subset of the GitHub REST API that script.py uses."""
+
+    repos = {}
+    traffic = None
+    latency = 0.0
+    # Rate-limit window, see send()
+    reset_lock = threading.Lock()
+    reset_at = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def url(self, path):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}{path}"
+
+    def send(self, status, payload=None, raw=None, remaining="4999"):
+        body = json.dumps(payload).encode() if payload is not None else raw or b""
+        etag = f'"{sha1(body)}"'
+        if status == 200 and self.command == "GET":
+            if self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+        self.send_response(status)
+        if self.command == "GET" and status in (200, 304):
+            self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.send_header("X-RateLimit-Remaining", remaining)
+        with self.reset_lock:
+            # An exhausted window resets a second later, a fresh one in an hour
+            now = int(time.time())
+            if remaining == "0":
+                FakeGitHub.reset_at = now + 1
+            elif self.reset_at <= now:
+                FakeGitHub.reset_at = now + 3600
+            self.send_header("X-RateLimit-Reset", str(self.reset_at))
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(body)
+        request_bytes = int(self.headers.get("Content-Length") or 0)
+        self.traffic.record("github", request_bytes + len(body))
+
+    def body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_PATCH(self):
+        self.route("PATCH")
+
+    def route(self, verb):
+        time.sleep(self.latency)
+        failure = self.traffic.should_fail()
+        if failure:
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if failure % 2:
+                return self.send(
+                    429, {"message": "You have exceeded a secondary rate limit"}
+                )
+            # Primary limit: no Retry-After, only the reset time
+            return self.send(403, {"message": "API rate limit exceeded"}, remaining="0")
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        match = re.match(r"/repos/([^/]+/[^/]+)(?:/(.*))?$", parsed.path)
+        if not match or match.group(1) not in self.repos:
+            return self.send(404, {"message": "Not Found"})
+        repo = self.repos[match.group(1)]
+        rest = match.group(2) or ""
+        with self.server.lock:
+            for pattern, handler_verb, handler in self.routes():
+                route_match = re.fullmatch(pattern, rest)
+                if route_match and handler_verb == verb:
+                    return handler(repo, query, *route_match.groups())
+        self.send(404, {"message": f"No fake for {verb} {rest}"})
+
+    def routes(self):
+        return [
+            (r"", "GET", self.get_repo),
+            (r"branches/(.+)", "GET", self.get_branch),
+            (r"git/trees/(\w+)", "GET", self.get_tree),
+            (r"git/trees", "POST", self.create_tree),
+            (r"git/blobs/(\w+)", "GET", self.get_blob),
+            (r"git/commits/(\w+)", "GET", self.get_commit),
+            (r"git/commits", "POST", self.create_commit),
+            (r"git/refs/heads/(.+)", "GET", self.get_ref),
+            (r"git/refs/heads/(.+)", "PATCH", self.update_ref),
+            (r"git/refs", "POST", self.create_ref),
+            (r"contents/?(.*)", "GET", self.get_contents),
+            (r"contents/(.+)", "PUT", self.put_contents),
+            (r"pulls", "POST", self.create_pull),
+            (r"pulls/(\d+)", "GET", self.get_pull),
+            (r"pulls/(\d+)", "PATCH", self.edit_pull),
+            (r"pulls/(\d+)/files", "GET", self.get_pull_files),
+            (r"issues/(\d+)", "GET", self.get_issue),
+            (r"issues/(\d+)", "PATCH", self.edit_issue),
+        ]
+
+    def repo_url(self, repo, path=""):
+        return self.url(f"/repos/{repo.full_name}{path}")
+
+    def get_repo(self, repo, query):
+        owner, name = repo.full_name.split("/")
+        self.send(
+            200,
+            {
+                "full_name": repo.full_name,
+                "name": name,
+                "owner": {"login": owner},
+                "url": self.repo_url(repo),
+                "default_branch": "main",
+            },
+        )
+
+    def commit_json(self, repo, sha):
+        commit = repo.commits[sha]
+        return {
+            "sha": sha,
+            "url": self.repo_url(repo, f"/git/commits/{sha}"),
+            "message": commit["message"],
+            "tree": {
+                "sha": commit["tree"],
+                "url": self.repo_url(repo, f"/git/trees/{commit['tree']}"),
+            },
+            "parents": [
+                {"sha": parent, "url": self.repo_url(repo, f"/git/commits/{parent}")}
+                for parent in commit["parents"]
+            ],
+        }
+
+    def ref_json(self, repo, branch):
+        sha = repo.branches[branch]
+        return {
+            "ref": f"refs/heads/{branch}",
+            "url": self.repo_url(repo, f"/git/refs/heads/{branch}"),
+            "object": {
+                "sha": sha,
+                "type": "commit",
+                "url": self.repo_url(repo, f"/git/commits/{sha}"),
+            },
+        }
+
+    def get_branch(self, repo, query, branch):
+        if branch not in repo.branches:
+            return self.send(404, {"message": "Branch not found"})
+        self.send(
+            200,
+            {
+                "name": branch,
+                "commit": self.commit_json(repo, repo.branches[branch]),
+            },
+        )
+
+    def get_tree(self, repo, query, sha):
+        if sha in repo.commits:
+            sha = repo.commits[sha]["tree"]
+        entries = repo.trees[sha]
+        directories = {
+            "/".join(path.split("/")[:depth])
+            for path in entries
+            for depth in range(1, path.count("/") + 1)
+        }
+        tree = [
+            {"path": path, "mode": "040000", "type": "tree", "sha": sha1(path.encode())}
+            for path in sorted(directories)
+        ] + [
+            {
+                "path": path,
+                "mode": "100644",
+                "type": "blob",
+                "sha": blob,
+                "size": len(repo.blobs[blob]),
+                "url": self.repo_url(repo, f"/git/blobs/{blob}"),
+            }
+            for path, blob in sorted(entries.items())
+        ]
+        self.send(
+            200,
+            {
+                "sha": sha,
+                "url": self.repo_url(repo, f"/git/trees/{sha}"),
+                "tree": tree,
+                "truncated": False,
+            },
+        )
+
+    def create_tree(self, repo, query):
+        payload = self.body()
+        files = dict(repo.trees.get(payload.get("base_tree"), {}))
+        files = {path: repo.blobs[sha] for path, sha in files.items()}
+        for element in payload["tree"]:
+            if "content" in element:
+                files[element["path"]] = element["content"].encode("utf-8")
+            else:
+                files[element["path"]] = repo.blobs[element["sha"]]
+        sha = repo.tree(files)
+        self.send(201, {"sha": sha, "url": self.repo_url(repo, f"/git/trees/{sha}")})
+
+    def get_blob(self, repo, query, sha):
+        data = repo.blobs[sha]
+        if self.headers.get("Accept") == "application/vnd.github.raw":
+            return self.send(200, raw=data)
+        self.send(
+            200,
+            {
+                "sha": sha,
+                "size": len(data),
+                "encoding": "base64",
+                "content": base64.b64encode(data).decode(),
+                "url": self.repo_url(repo, f"/git/blobs/{sha}"),
+            },
+        )
+
+    def get_commit(self, repo, query, sha):
+        self.send(200, self.commit_json(repo, sha))
+
+    def create_commit(self, repo, query):
+        payload = self.body()
+        sha = repo.commit(payload["tree"], payload["parents"], payload["message"])
+        self.send(201, self.commit_json(repo, sha))
+
+    def get_ref(self, repo, query, branch):
+        if branch not in repo.branches:
+            return self.send(404, {"message": "Not Found"})
+        self.send(200, self.ref_json(repo, branch))
+
+    def create_ref(self, repo, query):
+        payload = self.body()
+        branch = payload["ref"][len("refs/heads/") :]
+        if branch in repo.branches:
+            return self.send(422, {"message": "Reference already exists"})
+        repo.branches[branch] = payload["sha"]
+        self.send(201, self.ref_json(repo, branch))
+
+    def update_ref(self, repo, query, branch):
+        repo.branches[branch] = self.body()["sha"]
+        self.send(200, self.ref_json(repo, branch))
+
+    def content_json(self, repo, path, data, ref):
+        return {
+            "type": "file",
+            "name": path.split("/")[-1],
+            "path": path,
+            "sha": blob_sha(data),
+            "size": len(data),
+            "encoding": "base64",
+            "content": base64.b64encode(data).decode(),
+            "url": self.repo_url(repo, f"/contents/{path}?ref={ref}"),
+        }
+
+    def get_contents(self, repo, query, path):
+        ref = query.get("ref", ["main"])[0]
+        files = repo.files(ref)
+        if path in files:
+            return self.send(200, self.content_json(repo, path, files[path], ref))
+        prefix = f"{path}/" if path else ""
+        children = {
+            p[len(prefix) :].split("/")[0] for p in files if p.startswith(prefix)
+        }
+        if not children:
+            return self.send(404, {"message": "Not Found"})
+        listing = []
+        for child in sorted(children):
+            child_path = prefix + child
+            if child_path in files:
+                listing.append(
+                    self.content_json(repo, child_path, files[child_path], ref)
+                )
+            else:
+                listing.append(
+                    {
+                        "type": "dir",
+                        "name": child,
+                        "path": child_path,
+                        "sha": sha1(child_path.encode()),
+                        "url": self.repo_url(repo, f"/contents/{child_path}"),
+                    }
+                )
+        self.send(200, listing)
+
+    def put_contents(self, repo, query, path):
+        payload = self.body()
+        branch = payload.get("branch", "main")
+        if branch == "main":
+            # main is protected, as in most QMS repositories
+            return self.send(
+                409, {"message": "Changes must be made through a pull request."}
+            )
+        files = repo.files(branch)
+        current = files.get(path)
+        if "sha" in payload and (
+            current is None or blob_sha(current) != payload["sha"]
+        ):
+            return self.send(
+                409, {"message": f"{path} does not match {payload['sha']}"}
+            )
+        if "sha" not in payload and current is not None:
+            return self.send(
+                422, {"message": 'Invalid request.\n\n"sha" wasn\'t supplied.'}
+            )
+        files[path] = base64.b64decode(payload["content"])
+        commit_sha = repo.commit(
+            repo.tree(files), [repo.branches[branch]], payload["message"]
+        )
+        repo.branches[branch] = commit_sha
+        self.send(
+            201 if current is None else 200,
+            {
+                "content": self.content_json(repo, path, files[path], branch),
+                "commit": self.commit_json(repo, commit_sha),
+            },
+        )
+
+    def pull_json(self, repo, number):
+        pull = repo.pulls[number]
+        return {
+            "number": number,
+            "title": pull["title"],
+            "body": pull["body"],
+            "url": self.repo_url(repo, f"/pulls/{number}"),
+            "html_url": f"https://github.com/{repo.full_name}/pull/{number}",
+            "head": {"ref": pull["head"], "sha": repo.branches[pull["head"]]},
+            "base": {"ref": pull["base"], "sha": repo.branches[pull["base"]]},
+        }
+
+    def create_pull(self, repo, query):
+        payload = self.body()
+        number = len(repo.pulls) + 1
+        repo.pulls[number] = {
+            key: payload.get(key) for key in ("title", "body", "head", "base")
+        }
+        self.send(201, self.pull_json(repo, number))
+
+    def get_pull(self, repo, query, number):
+        self.send(200, self.pull_json(repo, int(number)))
+
+    def edit_pull(self, repo, query, number):
+        repo.pulls[int(number)].update(self.body())
+        self.send(200, self.pull_json(repo, int(number)))
+
+    def get_pull_files(self, repo, query, number):
+        pull = repo.pulls[int(number)]
+        head, base = repo.files(pull["head"]), repo.files(pull["base"])
+        changed = [path for path in head if base.get(path) != head[path]]
+        if query.get("page", ["1"])[0] != "1":
+            changed = []
+        self.send(
+            200,
+            [
+                {"filename": path, "sha": blob_sha(head[path]), "status": "modified"}
+                for path in changed
+            ],
+        )
+
+    def issue_json(self, repo, number):
+        issue = repo.issues[number]
+        return {
+            "number": number,
+            "title": issue["title"],
+            "body": issue["body"],
+            "url": self.repo_url(repo, f"/issues/{number}"),
+            "updated_at": issue["updated_at"],
+        }
+
+    def get_issue(self, repo, query, number):
+        self.send(200, self.issue_json(repo, int(number)))
+
+    def edit_issue(self, repo, query, number):
+        issue = repo.issues[int(number)]
+        issue.update(self.body())
+        issue["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        self.send(200, self.issue_json(repo, int(number)))
+
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    """Chat completions with artificial latency and configurable output size."""
+
+    traffic = None
+    latency = 0.0
+    tokens = 200
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length))
+        if self.traffic.should_fail():
+            body = b'{"error": {"message": "Rate limit reached", "type": "requests"}}'
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("retry-after-ms", "50")
+            self.end_headers()
+            self.wfile.write(body)
+            self.traffic.record("openai", length + len(body))
+            return
+        content = self.answer(request)
+        prompt_tokens = sum(len(m["content"]) for m in request["messages"]) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4,
+        }
+        time.sleep(self.latency)
+        if request.get("stream"):
+            body = self.stream_body(request, content, usage)
+            content_type = "text/event-stream"
+        else:
+            body = json.dumps(
+                {
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                }
+            ).encode()
+            content_type = "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-ratelimit-limit-requests", "500")
+        self.send_header("x-ratelimit-remaining-requests", "499")
+        self.send_header("x-ratelimit-limit-tokens", "200000")
+        self.send_header("x-ratelimit-remaining-tokens", "190000")
+        self.end_headers()
+        self.wfile.write(body)
+        self.traffic.record("openai", length + len(body))
+
+    def stream_body(self, request, content, usage):
+        def chunk(choices, **extra):
+            return "data: " + json.dumps(
+                dict(
+                    {
+                        "id": "chatcmpl-bench",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": request["model"],
+                        "choices": choices,
+                    },
+                    **extra,
+                )
+            )
+
+        events = [
+            chunk([{"index": 0, "delta": {"content": content[i : i + 40]}}])
+            for i in range(0, len(content), 40)
+        ]
+        events.append(chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if request.get("stream_options", {}).get("include_usage"):
+            events.append(chunk([], usage=usage))
+        events.append("data: [DONE]")
+        return ("\n\n".join(events) + "\n\n").encode()
+
+    def padding(self):
+        return " ".join(["lorem"] * self.tokens)
+
+    def answer(self, request):
+        messages = request["messages"]
+        text = "\n".join(message["content"] for message in messages)
+        json_mode = request.get("response_format", {}).get("type") == "json_object"
+        if json_mode and "most appropriate option" in text:
+            return json.dumps({"option": 0})
+        if json_mode and "determine which files to update" in text:
+            listed = re.findall(r"^- ([^\s]+)", text.split("Files:")[-1], re.M)
+            return json.dumps({"files": listed[:2]})
+        if json_mode and "provide a title and body" in text:
+            return json.dumps({"title": "Update QMS documents", "body": self.padding()})
+        if json_mode and "change request record" in text:
+            record = text.split("Current change request record:\n", 1)[1]
+            first_line = record.split("\n", 1)[0]
+            if "'edits'" in text:
+                return json.dumps(
+                    {
+                        "edits": [{"search": first_line, "replace": first_line + " "}],
+                        "summary": self.padding(),
+                    }
+                )
+            return json.dumps(
+                {"updated_content": record.split("\n\nIssue Title:")[0], "summary": ""}
+            )
+        if "Analyze if any updates are needed" in text:
+            # Update the records about what the issue observed, as far as the
+            # prompt shows them
+            ids = re.findall(r'\{\s*"id": "([^"]+)"[^{}]*?battery charging', text)
+            return (
+                "".join(f"UPDATE {record_id}\n" for record_id in dict.fromkeys(ids))
+                + self.padding()
+            )
+        if json_mode:
+            return json.dumps({})
+        if "search/replace blocks" in messages[-1]["content"]:
+            content = messages[-2]["content"].split("File content:\n", 1)[1]
+            lines = content.split("\n")
+            line = next(line for line in lines if line and content.count(line) == 1)
+            return (
+                f"<<<<<<< SEARCH\n{line}\n=======\n{line} "
+                f"{self.padding()}\n>>>>>>> REPLACE"
+            )
+        if "Now update this file" in messages[-1]["content"]:
+            return messages[-2]["content"].split("File content:\n", 1)[1]
+        section = re.search(r"filling out section (.*?) of the change", text)
+        if section:
+            return f"{section.group(1)}\n\n{self.padding()}"
+        if "revision log" in messages[0]["content"]:
+            return messages[1]["content"].split("\n\nSections updated")[0]
+        return self.padding()
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.lock = threading.Lock()
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def build_repos(size):
+    files = qms_files(size)
+    target = GitRepo(TARGET_REPO, files)
+    # An open change control PR that option 2 updates
+    head_files = dict(files)
+    head_files[CR_RECORD] = head_files[CR_RECORD].replace(b"Existing", b"Proposed")
+    target.branches["change-control-CR001"] = target.commit(
+        target.tree(head_files), [target.branches["main"]], "Change control"
+    )
+    target.pulls[1] = {
+        "title": "Change Control: Existing change",
+        "body": "",
+        "head": "change-control-CR001",
+        "base": "main",
+    }
+    current = GitRepo(CURRENT_REPO, {"README.md": b"# Product\n"})
+    current.issues[1] = {
+        "title": "Improve battery handling",
+        "body": issue_body(size),
+        "updated_at": "2024-01-01T00:00:00Z",
+    }
+    return {
+        TARGET_REPO: target,
+        # A second product repo with the same documents, for the fan-out
+        SECOND_REPO: GitRepo(SECOND_REPO, files),
+        DOCS_REPO: GitRepo(DOCS_REPO, files),
+        CURRENT_REPO: current,
+    }
+
+
+def issue_body(size):
+    return (
+        "Requestor: Jane Doe\nManagement approval: John Roe\nQA approval: Sam Poe\n\n"
+        "2.3 DTM impact: component-3 user needs change.\n"
+        "2.4 Risk impact: new failure mode for component-3.\n"
+        "2.5 Observation: battery charging fails at low temperature.\n\n"
+        "<change_control_pr>https://github.com/bench/qms/pull/1</change_control_pr>\n\n"
+        "<!--qms-section:dtm-->\nYes / No / Other\n<!--/qms-section:dtm-->\n\n"
+        "<!--qms-section:fmea-->\nYes / No / Other\n<!--/qms-section:fmea-->\n"
+    )
+
+
+def check_cr_number(repos, reference):
+    """The new change request record is numbered after every existing one."""
+    target = repos[TARGET_REPO]
+    pattern = re.compile(r"change-request-records/CR(\d+)-")
+    existing = {path for path in target.files("main") if pattern.match(path)}
+    created = {
+        path
+        for branch in target.branches
+        for path in target.files(branch)
+        if pattern.match(path) and path not in existing
+    }
+    if not created:
+        return "no change request record was created"
+    latest = max(int(pattern.match(path).group(1)) for path in existing)
+    for path in created:
+        if int(pattern.match(path).group(1)) <= latest:
+            return f"{path} does not follow CR{latest:03d}"
+    return None
+
+
+def proposed_record_ids(repos):
+    return set(
+        re.findall(r"UPDATE ((?:UN|FM)-\d+)", repos[CURRENT_REPO].issues[1]["body"])
+    )
+
+
+def check_qms_context(repos, reference):
+    """Retrieval keeps every record the full-context run proposes to update."""
+    expected = proposed_record_ids(reference)
+    if not expected:
+        return "the full-context run proposed no updates"
+    missing = expected - proposed_record_ids(repos)
+    if missing:
+        return f"retrieval left out {', '.join(sorted(missing))}"
+    return None
+
+
+SCENARIOS = {
+    "update-qms": {"instruction": "Update the QMS documents for this issue"},
+    "update-qms-2repos": {
+        "instruction": "Update the QMS documents for this issue",
+        "target_repo": f"{TARGET_REPO},{SECOND_REPO}",
+    },
+    "create-cr": {
+        "instruction": "Create a change control record",
+        "pr_title": "Battery handling",
+        "check": check_cr_number,
+    },
+    "update-cr": {
+        "instruction": "Update change control record",
+        "pr_title": "Battery handling",
+    },
+    "dtm-fmea": {
+        "instruction": "Propose Design Traceability Matrix and/or FMAE updates",
+        # The same issue with the whole documents in the prompts
+        "reference_env": {"INPUT_QMS_CONTEXT_MODE": "full"},
+        "check": check_qms_context,
+    },
+}
+
+
+def run_script(env, workdir):
+    return subprocess.run(
+        [sys.executable, os.path.join(HERE, "script.py")],
+        env=env,
+        cwd=workdir,
+        capture_output=True,
+        text=True,
+    )
+
+
+def run_scenario(name, size, github, openai, traffic):
+    scenario = SCENARIOS[name]
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(
+            os.environ,
+            INPUT_GITHUB_API_URL=f"http://127.0.0.1:{github.server_address[1]}",
+            OPENAI_BASE_URL=f"http://127.0.0.1:{openai.server_address[1]}/v1",
+            INPUT_GITHUB_TOKEN="bench",
+            INPUT_QMS_PAT="bench",
+            INPUT_OPENAI_KEY="bench",
+            INPUT_TARGET_REPO=scenario.get("target_repo", TARGET_REPO),
+            INPUT_QMS_DOCS_REPO=DOCS_REPO,
+            INPUT_INSTRUCTION=scenario["instruction"],
+            INPUT_ISSUE_TITLE=f"Improve battery handling {name} {size}",
+            INPUT_ISSUE_BODY=issue_body(size),
+            INPUT_ISSUE_URL=f"https://github.com/{CURRENT_REPO}/issues/1",
+            INPUT_PR_TITLE=scenario.get("pr_title", ""),
+            INPUT_PR_BODY="Unit tests and acceptance tests pass.",
+            INPUT_PR_URL=f"https://github.com/{CURRENT_REPO}/pull/2",
+            INPUT_CACHE_DIR=os.path.join(workdir, "cache"),
+            INPUT_METRICS_FILE=os.path.join(workdir, "metrics.jsonl"),
+        )
+        env.pop("GITHUB_STEP_SUMMARY", None)
+        reference = None
+        if "reference_env" in scenario:
+            # An unmeasured run that the check compares the measured one with
+            FakeGitHub.repos = build_repos(size)
+            run_script(
+                dict(
+                    env,
+                    INPUT_CACHE_DIR=os.path.join(workdir, "reference-cache"),
+                    **scenario["reference_env"],
+                ),
+                workdir,
+            )
+            reference = FakeGitHub.repos
+        FakeGitHub.repos = build_repos(size)
+        traffic.reset()
+        start = time.perf_counter()
+        process = run_script(env, workdir)
+        seconds = time.perf_counter() - start
+    result = dict(traffic.snapshot(), seconds=round(seconds, 3))
+    result["ok"] = process.returncode == 0 and "::set-output name=result::" in (
+        process.stdout
+    )
+    if not result["ok"]:
+        print(process.stdout[-2000:], process.stderr[-4000:], sep="\n")
+    elif scenario.get("check"):
+        error = scenario["check"](FakeGitHub.repos, reference)
+        if error:
+            print(f"{name}/{size}: {error}")
+            result["ok"] = False
+    return result
+
+
+def compare(results, baseline):
+    regressions = []
+    for key, result in results.items():
+        if not result["ok"]:
+            regressions.append(f"{key}: run failed")
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        for metric, tolerance in TOLERANCES.items():
+            limit = previous[metric] * (1 + tolerance)
+            if metric == "seconds":
+                # Ignore jitter on very fast scenarios
+                limit = max(limit, previous[metric] + 0.5)
+            if result[metric] > limit:
+                regressions.append(
+                    f"{key}: {metric} {result[metric]} > baseline {previous[metric]}"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="10,100,500")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--llm-tokens", type=int, default=200)
+    parser.add_argument("--github-latency", type=float, default=0.0)
+    parser.add_argument(
+        "--fail-every",
+        type=int,
+        default=0,
+        help="answer every Nth API request with a rate-limit error (GitHub alternates a 429 with Retry-After and a primary-limit 403 without) to exercise retries",
+    )
+    parser.add_argument(
+        "--baseline", default=os.path.join(HERE, "benchmark-baseline.json")
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    traffic = Traffic(args.fail_every)
+    FakeGitHub.traffic = FakeOpenAI.traffic = traffic
+    FakeOpenAI.latency = args.llm_latency
+    FakeOpenAI.tokens = args.llm_tokens
+    FakeGitHub.latency = args.github_latency
+    github, openai = start_server(FakeGitHub), start_server(FakeOpenAI)
+
+    results = {}
+    print(f"{'scenario':<22}{'seconds':>9}{'github':>8}{'openai':>8}{'bytes':>12}  ok")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        for name in args.scenarios.split(","):
+            key = f"{name}/{size}"
+            results[key] = run_scenario(name, size, github, openai, traffic)
+            result = results[key]
+            print(
+                f"{key:<22}{result['seconds']:>9.2f}{result['github_calls']:>8}"
+                f"{result['openai_calls']:>8}{result['bytes']:>12}  {result['ok']}"
+            )
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
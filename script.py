@@ -3,181 +3,1908 @@ import sys
 import json
 import re
 import base64
+import email.utils
+import io
+import hashlib
+import heapq
+import importlib.metadata
 import requests
-from github import Github
-from openai import OpenAI
+import httpx
+from github.Requester import Requester
+from github import (
+    Github,
+    GithubException,
+    InputGitTreeElement,
+    UnknownObjectException,
+)
+from openai import DefaultHttpxClient, OpenAI
 import datetime
+import math
+import collections
+import threading
+import time
+import random
+import contextlib
+import contextvars
+import copy
+import functools
+import signal
+import tempfile
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
 
 # Constants
 MODEL = "gpt-4o"
+FAST_MODEL = "gpt-4o-mini"
+# Model per LLM stage; stages not listed use MODEL. Overridden with the
+# model_routes input, where "default" replaces MODEL.
+DEFAULT_MODEL_ROUTES = {
+    "classification": FAST_MODEL,
+    "file selection": FAST_MODEL,
+    "PR summary": FAST_MODEL,
+    "context summary": FAST_MODEL,
+}
+
+
+def get_int_input(name, default):
+    value = os.environ.get(f"INPUT_{name}")
+    return int(value) if value else default
+
+
+def get_model(route):
+    routes = dict(DEFAULT_MODEL_ROUTES)
+    routes.update(json.loads(os.environ.get("INPUT_MODEL_ROUTES") or "{}"))
+    return routes.get(route) or routes.get("default") or MODEL
+
+
+# Clients are built once per process and reused by every helper, so all
+# calls share one keep-alive connection pool per API.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(name, factory):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
 
 
 # OpenAI Client initialization
 def get_openai_client():
-    return OpenAI(api_key=os.environ["INPUT_OPENAI_KEY"])
+    pool_size = get_int_input("HTTP_POOL_SIZE", 10)
+    return _get_client(
+        "openai",
+        lambda: OpenAI(
+            api_key=os.environ["INPUT_OPENAI_KEY"],
+            timeout=get_int_input("OPENAI_TIMEOUT", 600),
+            # Retries are left to the scheduled transport
+            max_retries=0,
+            http_client=DefaultHttpxClient(
+                transport=ScheduledTransport(
+                    httpx.HTTPTransport(
+                        limits=httpx.Limits(
+                            max_connections=pool_size,
+                            max_keepalive_connections=pool_size,
+                        )
+                    ),
+                    get_rate_limiter("openai"),
+                )
+            ),
+        ),
+    )
 
 
 # GitHub Client initialization
+def get_github_api_url():
+    # Not the runner's GITHUB_API_URL: on GitHub Enterprise that would send the
+    # QMS token to the Enterprise host, while the QMS repos are on github.com
+    return os.environ.get("INPUT_GITHUB_API_URL") or "https://api.github.com"
+
+
 def get_github_qms_client():
-    return Github(os.environ["INPUT_QMS_PAT"])
+    return _get_client(
+        "github_qms",
+        lambda: Github(
+            os.environ["INPUT_QMS_PAT"],
+            base_url=get_github_api_url(),
+            timeout=get_int_input("GITHUB_TIMEOUT", 15),
+            pool_size=get_int_input("HTTP_POOL_SIZE", 10),
+        ),
+    )
 
 
 def get_github_current_client():
-    return Github(os.environ["INPUT_GITHUB_TOKEN"])
+    return _get_client(
+        "github_current",
+        lambda: Github(
+            os.environ["INPUT_GITHUB_TOKEN"],
+            base_url=get_github_api_url(),
+            timeout=get_int_input("GITHUB_TIMEOUT", 15),
+            pool_size=get_int_input("HTTP_POOL_SIZE", 10),
+        ),
+    )
+
+
+def run_concurrently(tasks, max_workers):
+    """Run zero-argument callables on a bounded thread pool.
+
+    Returns a list of (result, error) tuples in the order of ``tasks``.
+    """
+    results = [(None, None)] * len(tasks)
+    if not tasks:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # Tasks run in a copy of the caller's context so they report to its stage
+        futures = {
+            executor.submit(contextvars.copy_context().run, task): index
+            for index, task in enumerate(tasks)
+        }
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = (future.result(), None)
+            except Exception as e:
+                results[futures[future]] = (None, e)
+    return results
+
+
+# Work shared between the target repositories of one job. A step keyed by its
+# inputs runs once; repositories reaching it later, or while it is running,
+# get the same result. Repos holding the same documents thus cost one set of
+# model calls.
+_shared_work = contextvars.ContextVar("shared_work", default=None)
+_shared_work_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def shared_work():
+    """Share keyed results between the repositories handled in the block."""
+    token = _shared_work.set({})
+    try:
+        yield
+    finally:
+        _shared_work.reset(token)
+
+
+def run_shared(key, compute):
+    """Return ``compute()``, reusing the result of an earlier call with ``key``."""
+    results = _shared_work.get()
+    if results is None:
+        return compute()
+    digest = hashlib.sha256(
+        json.dumps(key, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    with _shared_work_lock:
+        future = results.get(digest)
+        owner = future is None
+        if owner:
+            future = results[digest] = Future()
+    if owner:
+        try:
+            future.set_result(compute())
+        except BaseException as e:
+            # Later callers try again instead of inheriting the failure
+            with _shared_work_lock:
+                results.pop(digest, None)
+            future.set_exception(e)
+    return future.result()
+
+
+# Instrumentation. Work is grouped into named stages; wall time, token usage
+# and GitHub API calls are attributed to the innermost running stage and to
+# the run totals, and reported as JSON lines and a step summary table.
+METRIC_FIELDS = (
+    "llm_calls",
+    "prompt_tokens",
+    "cached_prompt_tokens",
+    "completion_tokens",
+    "github_calls",
+    "github_cache_hits",
+    "retries",
+)
+_current_stage = contextvars.ContextVar("stage", default=None)
+_metrics = {
+    "stages": [],
+    "totals": collections.Counter(),
+    "models": collections.Counter(),
+    "rate_limit": None,
+}
+_metrics_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def stage(name):
+    record = {"stage": name, "started_at": round(time.time(), 3)}
+    record.update({field: 0 for field in METRIC_FIELDS})
+    token = _current_stage.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        _current_stage.reset(token)
+        with _metrics_lock:
+            _metrics["stages"].append(record)
+
+
+def _add_metrics(**values):
+    record = _current_stage.get()
+    with _metrics_lock:
+        _metrics["totals"].update(values)
+        if record is not None:
+            for field, value in values.items():
+                record[field] += value
+
+
+def record_usage(usage, model=None):
+    if usage is None:
+        return
+    if model:
+        # Which model served the stage, for comparing routes between runs
+        record = _current_stage.get()
+        with _metrics_lock:
+            _metrics["models"][model] += 1
+            if record is not None:
+                record["model"] = model
+    details = getattr(usage, "prompt_tokens_details", None)
+    _add_metrics(
+        llm_calls=1,
+        prompt_tokens=usage.prompt_tokens,
+        completion_tokens=usage.completion_tokens,
+        cached_prompt_tokens=getattr(details, "cached_tokens", None) or 0,
+    )
+
+
+def _count_github_calls(method):
+    # Wraps Requester.__requestRaw, which every GitHub API request goes through
+    @functools.wraps(method)
+    def wrapper(self, cnx, verb, url, requestHeaders, input):
+        status, headers, output = method(self, cnx, verb, url, requestHeaders, input)
+        _add_metrics(github_calls=1)
+        if "x-ratelimit-remaining" in headers and "x-ratelimit-limit" in headers:
+            with _metrics_lock:
+                _metrics["rate_limit"] = (
+                    int(headers["x-ratelimit-remaining"]),
+                    int(headers["x-ratelimit-limit"]),
+                )
+        return status, headers, output
+
+    return wrapper
+
+
+def report_metrics():
+    with _metrics_lock:
+        stages = sorted(_metrics["stages"], key=lambda record: record["started_at"])
+        totals = {field: _metrics["totals"][field] for field in METRIC_FIELDS}
+        models = dict(_metrics["models"])
+        rate_limit = _metrics["rate_limit"]
+    if not stages:
+        return
+    remaining = f"{rate_limit[0]}/{rate_limit[1]}" if rate_limit else "unknown"
+    print(
+        f"Token usage: {totals['llm_calls']} calls, "
+        f"{totals['prompt_tokens']} prompt tokens "
+        f"({totals['cached_prompt_tokens']} cached), "
+        f"{totals['completion_tokens']} completion tokens"
+    )
+    if models:
+        print(
+            "Models: "
+            + ", ".join(f"{model} ({calls} calls)" for model, calls in models.items())
+        )
+    print(
+        f"GitHub API calls: {totals['github_calls']}, rate limit remaining: {remaining}"
+    )
+
+    metrics_file = os.environ.get("INPUT_METRICS_FILE") or os.path.join(
+        get_runner_temp_dir(), "qms-worker-metrics.jsonl"
+    )
+    with open(metrics_file, "a") as f:
+        for record in stages:
+            f.write(json.dumps(dict(record, type="stage")) + "\n")
+        f.write(
+            json.dumps(
+                dict(
+                    totals,
+                    type="run",
+                    models=models,
+                    seconds=round(time.time() - stages[0]["started_at"], 3),
+                    rate_limit_remaining=rate_limit[0] if rate_limit else None,
+                )
+            )
+            + "\n"
+        )
+
+    summary_file = os.environ.get("GITHUB_STEP_SUMMARY")
+    if summary_file:
+        rows = [
+            "| Stage | Model | Wall time (s) | LLM calls | Prompt tokens | Cached | Completion tokens | GitHub calls | GitHub cache hits | Retries |",
+            "| --- | --- | ---: | ---: | ---: | ---: | ---: | ---: | ---: | ---: |",
+        ]
+        for record in stages + [dict(totals, stage="**Total**", seconds="")]:
+            rows.append(
+                f"| {record['stage']} | {record.get('model', '')} | {record['seconds']} | "
+                + " | ".join(str(record[field]) for field in METRIC_FIELDS)
+                + " |"
+            )
+        with open(summary_file, "a") as f:
+            f.write("### QMS worker timings\n\n" + "\n".join(rows))
+            f.write(f"\n\nGitHub rate limit remaining: {remaining}\n")
+
+
+# Request scheduling. Calls to both APIs take from token buckets sized by the
+# rate-limit headers of earlier responses, and rate-limited or failed calls are
+# retried with jittered exponential backoff that honours Retry-After. A pause
+# applies to every caller of the API, so concurrent calls back off together.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.paused_until = 0.0
+
+    def _refill(self, bucket, now):
+        bucket["level"] = min(
+            bucket["capacity"],
+            bucket["level"] + (now - bucket["updated"]) * bucket["rate"],
+        )
+        bucket["updated"] = now
+
+    def update(self, kind, limit, remaining, period, reset=None):
+        """Size the ``kind`` bucket from a limit per ``period`` seconds.
+
+        ``reset`` identifies the limit window; in a new one the bucket is
+        refilled to ``remaining``.
+        """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(kind)
+            if bucket is None:
+                bucket = self.buckets[kind] = {"level": remaining, "updated": now}
+            elif reset is not None and reset != bucket.get("reset"):
+                bucket["level"] = remaining
+                bucket["updated"] = now
+            else:
+                self._refill(bucket, now)
+                # Requests still in flight are not in the header yet
+                bucket["level"] = min(bucket["level"], remaining)
+            bucket["reset"] = reset
+            bucket["capacity"] = limit
+            bucket["rate"] = limit / period
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self, weights):
+        """Block until every bucket can cover its weight, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.paused_until - now
+                for kind, weight in weights.items():
+                    bucket = self.buckets.get(kind)
+                    if bucket is None or not bucket["rate"]:
+                        continue
+                    self._refill(bucket, now)
+                    # A request larger than the bucket waits for a full bucket
+                    needed = min(weight, bucket["capacity"])
+                    if bucket["level"] < needed:
+                        delay = max(delay, (needed - bucket["level"]) / bucket["rate"])
+                if delay <= 0:
+                    for kind, weight in weights.items():
+                        if kind in self.buckets:
+                            self.buckets[kind]["level"] -= weight
+                    return
+            time.sleep(min(delay, 5))
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name):
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            _rate_limiters[name] = RateLimiter(name)
+        return _rate_limiters[name]
+
+
+def parse_retry_after(headers):
+    """Seconds to wait from Retry-After style headers, or None."""
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+
+
+def backoff_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 0.25)
+    # Full jitter keeps concurrent retries from arriving together
+    return random.uniform(0, min(get_int_input("BACKOFF_MAX", 60), 2**attempt))
+
+
+def estimate_request_tokens(body):
+    """Rough token weight of a chat completion request: prompt plus output cap."""
+    try:
+        request = json.loads(body)
+    except ValueError:
+        return 1
+    prompt_chars = sum(
+        len(message.get("content") or "") for message in request.get("messages", [])
+    )
+    output_cap = request.get("max_completion_tokens") or request.get("max_tokens") or 0
+    return prompt_chars // 4 + output_cap
+
+
+class ScheduledTransport(httpx.BaseTransport):
+    """httpx transport that paces and retries OpenAI requests."""
+
+    def __init__(self, transport, limiter):
+        self.transport = transport
+        self.limiter = limiter
+
+    def handle_request(self, request):
+        weights = {"requests": 1, "tokens": estimate_request_tokens(request.read())}
+        retries = get_int_input("RATE_LIMIT_RETRIES", 5)
+        for attempt in range(retries + 1):
+            self.limiter.acquire(weights)
+            try:
+                response = self.transport.handle_request(request)
+            except httpx.TransportError as e:
+                if attempt == retries:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"OpenAI request failed ({e}), retrying in {delay:.1f}s")
+            else:
+                for kind in weights:
+                    limit = response.headers.get(f"x-ratelimit-limit-{kind}")
+                    remaining = response.headers.get(f"x-ratelimit-remaining-{kind}")
+                    if limit and remaining:
+                        self.limiter.update(kind, int(limit), int(remaining), 60)
+                if response.status_code not in RETRY_STATUSES or attempt == retries:
+                    return response
+                retry_after = parse_retry_after(response.headers)
+                response.close()
+                delay = backoff_delay(attempt, retry_after)
+                if response.status_code == 429:
+                    self.limiter.pause(delay)
+                print(
+                    f"OpenAI returned {response.status_code}, "
+                    f"retrying in {delay:.1f}s"
+                )
+            _add_metrics(retries=1)
+            time.sleep(delay)
+
+
+def _github_retry_delay(status, headers, output, attempt):
+    """Backoff for a GitHub response worth retrying, or None."""
+    retry_after = parse_retry_after(headers)
+    # PyGithub hands over the body as text, raw blob downloads as bytes
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", "replace")
+    if status == 403 or status == 429:
+        if retry_after is not None or "secondary rate limit" in (output or ""):
+            return backoff_delay(attempt, retry_after)
+        if headers.get("x-ratelimit-remaining") == "0":
+            wait = float(headers.get("x-ratelimit-reset", 0)) - time.time()
+            # Waiting for the hourly reset is only worth it when it is close
+            if wait <= get_int_input("RATE_LIMIT_MAX_WAIT", 300):
+                return backoff_delay(attempt, max(wait, 0))
+        return None
+    if status in RETRY_STATUSES:
+        return backoff_delay(attempt, retry_after)
+    return None
+
+
+def get_github_rate_limiter(authorization):
+    # One bucket per token, the primary limit is per user
+    token = hashlib.sha256((authorization or "").encode("utf-8")).hexdigest()
+    return get_rate_limiter(("github", token))
+
+
+def _update_github_rate_limiter(limiter, headers):
+    if headers.get("x-ratelimit-limit") and headers.get("x-ratelimit-remaining"):
+        limiter.update(
+            "requests",
+            int(headers["x-ratelimit-limit"]),
+            int(headers["x-ratelimit-remaining"]),
+            3600,
+            headers.get("x-ratelimit-reset"),
+        )
+
+
+def _schedule_github_requests(method):
+    @functools.wraps(method)
+    def wrapper(self, cnx, verb, url, requestHeaders, input):
+        limiter = get_github_rate_limiter(requestHeaders.get("Authorization"))
+        # Uploads are file objects that cannot be sent twice; a POST that
+        # failed on the server may still have taken effect
+        retries = get_int_input("RATE_LIMIT_RETRIES", 5)
+        if isinstance(input, io.IOBase):
+            retries = 0
+        for attempt in range(retries + 1):
+            limiter.acquire({"requests": 1})
+            status, headers, output = method(
+                self, cnx, verb, url, requestHeaders, input
+            )
+            _update_github_rate_limiter(limiter, headers)
+            if attempt == retries or (verb == "POST" and status >= 500):
+                return status, headers, output
+            delay = _github_retry_delay(status, headers, output, attempt)
+            if delay is None:
+                return status, headers, output
+            if status in (403, 429):
+                limiter.pause(delay)
+            print(
+                f"GitHub returned {status} for {verb} {url}, retrying in {delay:.1f}s"
+            )
+            _add_metrics(retries=1)
+            time.sleep(delay)
+
+    return wrapper
+
+
+# Read-through cache for GitHub GETs. Within a job, repeated reads are served
+# from memory; writes to a repository drop its entries. Responses with an
+# ETag are also kept on disk and revalidated with If-None-Match on later runs,
+# and the resulting 304s do not count against the rate limit.
+_request_cache = contextvars.ContextVar("request_cache", default=None)
+_request_cache_lock = threading.Lock()
+_REPO_URL_PATTERN = re.compile(r"^(.*?/repos/[^/]+/[^/?]+)[/?]")
+
+
+@contextlib.contextmanager
+def request_cache():
+    """Serve repeated GitHub reads from memory until the block exits."""
+    token = _request_cache.set({})
+    try:
+        yield
+    finally:
+        _request_cache.reset(token)
+
+
+# Response bodies hold issue and PR text and private QMS file contents, so
+# they stay in this process unless http_cache asks for them on disk. The
+# batch worker still revalidates across jobs; the memory store is bounded.
+_http_memory_cache = collections.OrderedDict()
+HTTP_MEMORY_CACHE_ENTRIES = 1000
+
+
+def persist_http_cache():
+    return (os.environ.get("INPUT_HTTP_CACHE") or "memory").lower() == "disk"
+
+
+def _http_cache_path(key):
+    digest = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+    return os.path.join(get_blob_cache_dir(), "http", digest)
+
+
+def _read_http_cache(key):
+    if not persist_http_cache():
+        with _request_cache_lock:
+            entry = _http_memory_cache.get(key)
+            if entry is not None:
+                _http_memory_cache.move_to_end(key)
+        return entry
+    path = _http_cache_path(key)
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    os.utime(path)
+    return entry
+
+
+def _write_http_cache(key, headers, output):
+    if not persist_http_cache():
+        with _request_cache_lock:
+            _http_memory_cache[key] = {"headers": headers, "output": output}
+            _http_memory_cache.move_to_end(key)
+            while len(_http_memory_cache) > HTTP_MEMORY_CACHE_ENTRIES:
+                _http_memory_cache.popitem(last=False)
+        return
+    path = _http_cache_path(key)
+    with _blob_cache_lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"headers": headers, "output": output}, f)
+        os.replace(tmp_path, path)
+        _evict_cache(path)
+
+
+def _cache_github_reads(method):
+    @functools.wraps(method)
+    def wrapper(self, cnx, verb, url, requestHeaders, input):
+        memory = _request_cache.get()
+        if verb != "GET":
+            # Anything written to a repository may change what its reads return
+            repo_url = _REPO_URL_PATTERN.match(url)
+            if memory is not None and repo_url:
+                with _request_cache_lock:
+                    for key in [
+                        k for k in memory if k[1].startswith(repo_url[1] + "/")
+                    ]:
+                        del memory[key]
+            return method(self, cnx, verb, url, requestHeaders, input)
+
+        # Conditional requests made by the caller expect to see the 304
+        if "If-None-Match" in requestHeaders or "If-Modified-Since" in requestHeaders:
+            return method(self, cnx, verb, url, requestHeaders, input)
+
+        token = requestHeaders.get("Authorization") or ""
+        key = (
+            hashlib.sha256(token.encode("utf-8")).hexdigest(),
+            url,
+            requestHeaders.get("Accept"),
+        )
+        if memory is not None:
+            with _request_cache_lock:
+                cached = memory.get(key)
+            if cached is not None:
+                _add_metrics(github_cache_hits=1)
+                return cached
+
+        entry = _read_http_cache(key)
+        if entry is not None:
+            requestHeaders = dict(
+                requestHeaders, **{"If-None-Match": entry["headers"]["etag"]}
+            )
+        status, headers, output = method(self, cnx, verb, url, requestHeaders, input)
+        if status == 304 and entry is not None:
+            _add_metrics(github_cache_hits=1)
+            status, headers = 200, entry["headers"]
+            output = entry["output"]
+        elif (
+            status == 200
+            and "etag" in headers
+            and isinstance(output, str)
+            # Blobs never change and have their own cache
+            and "/git/blobs/" not in url
+        ):
+            _write_http_cache(key, headers, output)
+
+        if memory is not None and status == 200:
+            with _request_cache_lock:
+                memory[key] = (status, headers, output)
+        return status, headers, output
+
+    return wrapper
+
+
+# The wrappers replace name-mangled private methods of the Requester and rely
+# on their exact signatures in PyGithub 1.55, the version pinned in
+# requirements.txt. Any other version fails here instead of sending requests
+# through the wrong connection.
+PYGITHUB_VERSION = "1.55"
+if importlib.metadata.version("PyGithub") != PYGITHUB_VERSION:
+    raise ImportError(
+        f"PyGithub {PYGITHUB_VERSION} is required, found "
+        f"{importlib.metadata.version('PyGithub')}; review the Requester patches "
+        "before upgrading"
+    )
+
+# Innermost first: pacing and retries, call counting, then the cache, so
+# reads served from memory take neither rate-limit tokens nor API calls
+Requester._Requester__requestRaw = _cache_github_reads(
+    _count_github_calls(_schedule_github_requests(Requester._Requester__requestRaw))
+)
+
+
+# A PyGithub client keeps one connection object and stores each request on it
+# until the response is read, so threads sharing a client could get each
+# other's responses. Every thread gets its own copy of the connection; the
+# copies share the client's session and with it the keep-alive pool.
+_github_connections = threading.local()
+_github_connection_lock = threading.Lock()
+
+
+def _thread_github_connection(method):
+    @functools.wraps(method)
+    def wrapper(self):
+        with _github_connection_lock:
+            shared = method(self)
+        if not hasattr(_github_connections, "copies"):
+            _github_connections.copies = weakref.WeakKeyDictionary()
+        connection = _github_connections.copies.get(shared)
+        if connection is None:
+            connection = _github_connections.copies[shared] = copy.copy(shared)
+        return connection
+
+    return wrapper
+
+
+# Also tied to PyGithub 1.55, see PYGITHUB_VERSION
+Requester._Requester__createConnection = _thread_github_connection(
+    Requester._Requester__createConnection
+)
+
+
+class GenerationAborted(Exception):
+    pass
+
+
+def reject_code_fence(text):
+    # Documents must be returned as-is, not wrapped in ```markdown fences
+    stripped = text.lstrip()
+    if stripped.startswith("```"):
+        raise GenerationAborted("output starts with a code fence")
+    return len(stripped) >= 3
+
+
+def expect_json_object(text):
+    stripped = text.lstrip()
+    if stripped and not stripped.startswith("{"):
+        raise GenerationAborted("output is not a JSON object")
+    return bool(stripped)
+
+
+def stream_completion(client, label, validate=None, timeout=None, **kwargs):
+    """Run a chat completion, streaming the output when enabled.
+
+    ``validate`` is called with the output received so far until it returns
+    True; it raises GenerationAborted to cancel a generation that is going
+    off-format. A stream that stalls longer than the stall timeout, or is
+    still running after ``timeout`` seconds, fails.
+    """
+    with stage(f"llm {label}"):
+        if (os.environ.get("INPUT_STREAM") or "true").lower() != "true":
+            if timeout:
+                kwargs["timeout"] = timeout
+            response = client.chat.completions.create(**kwargs)
+            record_usage(response.usage, response.model)
+            content = response.choices[0].message.content
+            if validate:
+                validate(content)
+            return content
+
+        timeout = timeout or get_int_input("OPENAI_TIMEOUT", 600)
+        # The read timeout only bounds the gap between chunks, so the overall
+        # time is checked as the chunks arrive
+        deadline = time.monotonic() + timeout
+        stream = client.chat.completions.create(
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=httpx.Timeout(
+                timeout, read=min(timeout, get_int_input("STREAM_STALL_TIMEOUT", 30))
+            ),
+            **kwargs,
+        )
+        parts = []
+        received = 0
+        validated = validate is None
+        next_progress = 2000
+        try:
+            for chunk in stream:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"{label}: not completed within {timeout} s")
+                # The final chunk carries the usage and no choices
+                record_usage(getattr(chunk, "usage", None), chunk.model)
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                parts.append(chunk.choices[0].delta.content)
+                received += len(parts[-1])
+                if not validated:
+                    validated = validate("".join(parts))
+                if received >= next_progress:
+                    print(f"{label}: {received} characters received")
+                    next_progress += 2000
+        finally:
+            stream.close()
+
+        content = "".join(parts)
+        if not validated:
+            validate(content)
+        print(f"{label}: completed with {received} characters")
+        return content
+
+
+def complete_json(client, route, validate=None, **kwargs):
+    """Run a chat completion on the model routed for ``route`` and parse its JSON.
+
+    ``validate`` is called with the parsed object and raises ValueError,
+    KeyError or TypeError when it is unusable. Output from a routed model that
+    fails validation is requested again from the default model.
+    """
+    models = [get_model(route)]
+    if get_model("default") not in models:
+        models.append(get_model("default"))
+    for model in models:
+        response = client.chat.completions.create(
+            model=model, response_format={"type": "json_object"}, **kwargs
+        )
+        record_usage(response.usage, response.model)
+        try:
+            result = json.loads(response.choices[0].message.content)
+            if validate:
+                validate(result)
+            return result
+        except (ValueError, KeyError, TypeError) as e:
+            if model == models[-1]:
+                raise
+            print(
+                f"{route}: output from {model} failed validation ({e}), "
+                f"retrying with {models[-1]}"
+            )
+
+
+# Prompt budgets. Prompts are measured locally before they are sent. One that
+# is over the budget of its stage is compacted in a fixed order: the least
+# related files are dropped, logs and attachments in the issue body are cut
+# down, and then the issue body is replaced by a summary cached on disk. A
+# prompt that still does not fit fails before the call is made.
+DEFAULT_TOKEN_BUDGET = 100000
+_LOG_LINE_PATTERN = re.compile(
+    r"^\s*(\[?\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}|\[?\d{2}:\d{2}:\d{2}"
+    r"|\[?(TRACE|DEBUG|INFO|WARN|WARNING|ERROR|FATAL)\b"
+    r"|Traceback \(most recent call last\)|File \"|at \S+\()"
+)
+
+
+class PromptTooLarge(Exception):
+    pass
+
+
+def get_token_budget(route):
+    # Optional JSON input: {route: tokens}, where "default" applies to the rest
+    budgets = json.loads(os.environ.get("INPUT_TOKEN_BUDGETS") or "{}")
+    return int(budgets.get(route) or budgets.get("default") or DEFAULT_TOKEN_BUDGET)
+
+
+def estimate_tokens(text):
+    # Deliberately high: English averages about four characters per token
+    # and other scripts about one token per character of two or more bytes
+    return len((text or "").encode("utf-8")) // 3 + 1
+
+
+def estimate_prompt_tokens(messages):
+    return sum(estimate_tokens(message["content"]) + 4 for message in messages)
+
+
+def _shorten_lines(lines, keep):
+    if len(lines) <= keep:
+        return lines
+    head = keep * 2 // 3
+    return (
+        lines[:head]
+        + [f"... [{len(lines) - keep} lines truncated]"]
+        + lines[len(lines) - (keep - head) :]
+    )
+
+
+def truncate_attachments(text):
+    """Shorten code blocks, <details> blocks, log output and images in ``text``."""
+    keep = get_int_input("ATTACHMENT_LINES", 20)
+
+    def shorten_block(match):
+        body = "\n".join(_shorten_lines(match.group(2).split("\n"), keep))
+        return match.group(1) + body + match.group(3)
+
+    text = re.sub(r"(?ms)(^\s*```[^\n]*\n)(.*?)(\n\s*```[ \t]*$)", shorten_block, text)
+    text = re.sub(r"(?is)(<details[^>]*>)(.*?)(</details>)", shorten_block, text)
+    text = re.sub(r"!\[([^\]]*)\]\([^)]*\)", r"[image: \1]", text)
+
+    # Runs of log lines pasted outside of code blocks
+    lines = []
+    run = []
+    for line in text.split("\n") + [None]:
+        if line is not None and _LOG_LINE_PATTERN.match(line):
+            run.append(line)
+            continue
+        lines.extend(_shorten_lines(run, keep))
+        run = []
+        if line is not None:
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def _summary_cache_path(text):
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return os.path.join(get_blob_cache_dir(), "summaries", digest)
+
+
+def _summarize(text, max_tokens):
+    client = get_openai_client()
+    # Text too large for one summary call is summarized in parts
+    chunk_chars = get_token_budget("context summary") * 3 - 1000
+    chunks = [text[i : i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+    summaries = []
+    for chunk in chunks:
+        response = client.chat.completions.create(
+            model=get_model("context summary"),
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You are a QMS expert. Summarize the text below, taken from a GitHub issue or pull request, for someone who has to act on it. Keep names, approvals, IDs, URLs, version numbers, the stated DTM and risk impact and every explicit decision or requirement. Leave out logs, stack traces and attachments. Only respond with the summary.",
+                },
+                {"role": "user", "content": chunk},
+            ],
+            max_tokens=max(100, max_tokens // len(chunks)),
+            temperature=0,
+        )
+        record_usage(response.usage, response.model)
+        summaries.append(response.choices[0].message.content)
+    return "\n\n".join(summaries)
+
+
+@stage("llm context summary")
+def summarize_context(text):
+    """Return a summary of ``text``, made once and cached on disk."""
+    path = _summary_cache_path(text)
+    if os.path.isfile(path):
+        os.utime(path)
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    # Tokens are about four characters, the estimate assumes three
+    max_tokens = get_int_input("CONTEXT_SUMMARY_TOKENS", 2000) * 3 // 4
+    summary = run_shared(("summary", text), lambda: _summarize(text, max_tokens))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(summary)
+    os.replace(temp_path, path)
+    _evict_cache(path)
+    return summary
+
+
+def fit_prompt(route, build, files=None, issue_body=None, keep_files=1):
+    """Return the messages of ``build(files, issue_body)`` within the budget of ``route``.
+
+    ``files`` is ordered most related first; when compacting, files are
+    dropped from the end until ``keep_files`` are left.
+    """
+    budget = get_token_budget(route)
+    messages = build(files, issue_body)
+    tokens = estimate_prompt_tokens(messages)
+    if tokens <= budget:
+        return messages
+    print(f"{route}: prompt of about {tokens} tokens is over its budget of {budget}")
+
+    def over_budget():
+        return estimate_prompt_tokens(build(files, issue_body)) > budget
+
+    if files:
+        files = dict(files)
+        while len(files) > keep_files and over_budget():
+            path = list(files)[-1]
+            files.pop(path)
+            print(f"{route}: dropped {path} from the prompt")
+    # Compacting the issue body only helps if the rest of the prompt fits
+    room = budget - estimate_prompt_tokens(build(files, ""))
+    if issue_body and room > 0 and over_budget():
+        issue_body = truncate_attachments(issue_body)
+        print(f"{route}: truncated logs and attachments in the issue body")
+        if over_budget() and estimate_tokens(issue_body) > get_int_input(
+            "CONTEXT_SUMMARY_TOKENS", 2000
+        ):
+            issue_body = summarize_context(issue_body)
+            print(f"{route}: replaced the issue body with a summary")
+        if over_budget():
+            issue_body = issue_body.encode("utf-8")[: (room - 1) * 3].decode(
+                "utf-8", "ignore"
+            )
+            print(f"{route}: cut the issue body to fit")
+
+    messages = build(files, issue_body)
+    tokens = estimate_prompt_tokens(messages)
+    if tokens > budget:
+        raise PromptTooLarge(
+            f"{route}: prompt of about {tokens} tokens does not fit the budget of "
+            f"{budget} even after compaction"
+        )
+    return messages
+
+
+# Instruction dispatch. Bot-posted instructions are mostly canned phrases, so
+# an instruction that is exactly an option description is matched locally.
+# Options create branches and PRs, so looser local rules are only applied
+# when a repo configures them; everything else is left to the model.
+
+
+def normalize_instruction(instruction):
+    instruction = re.sub(r"[^\w\s]", " ", instruction.lower())
+    return " ".join(instruction.split())
+
+
+def get_instruction_rules():
+    # Optional JSON input: {"exact": {phrase: option}, "patterns": {regex: option},
+    # "keywords": {option: [[keyword, ...], ...]}}
+    rules = json.loads(os.environ.get("INPUT_INSTRUCTION_RULES") or "{}")
+    return {
+        "exact": {
+            normalize_instruction(phrase): int(option)
+            for phrase, option in rules.get("exact", {}).items()
+        },
+        "patterns": {
+            pattern: int(option)
+            for pattern, option in rules.get("patterns", {}).items()
+        },
+        "keywords": {
+            int(option): groups for option, groups in rules.get("keywords", {}).items()
+        },
+    }
+
+
+def match_instruction(instruction, options):
+    normalized = normalize_instruction(instruction)
+    padded = f" {normalized} "
+    rules = get_instruction_rules()
+
+    exact = dict(rules["exact"])
+    for option, description in options.items():
+        exact.setdefault(normalize_instruction(description), option)
+    if normalized in exact:
+        return exact[normalized]
+
+    # A stage only decides when all of its hits agree on one option
+    stages = [
+        {
+            option
+            for pattern, option in rules["patterns"].items()
+            if re.search(pattern, instruction, re.IGNORECASE)
+        },
+        {
+            option
+            for option, groups in rules["keywords"].items()
+            if any(
+                all(f" {keyword} " in padded for keyword in group) for group in groups
+            )
+        },
+    ]
+    for matches in stages:
+        if len(matches) == 1:
+            return matches.pop()
+        if matches:
+            break
+    return None
+
+
+def _classification_cache_path(instruction, options):
+    key = json.dumps([normalize_instruction(instruction), options], sort_keys=True)
+    return os.path.join(
+        get_blob_cache_dir(),
+        "classifications",
+        hashlib.sha256(key.encode("utf-8")).hexdigest(),
+    )
 
 
-# Utility functions
+@stage("classification")
 def analyze_instruction(instruction, options):
+    option = match_instruction(instruction, options)
+    if option is not None:
+        print(f"Instruction matched locally to option {option}")
+        return option
+
+    cache_path = _classification_cache_path(instruction, options)
+    cached = read_cache_file(cache_path)
+    try:
+        option = int(json.loads(cached)["option"]) if cached is not None else None
+    except (ValueError, KeyError, TypeError):
+        print("Cached instruction classification is unreadable, classifying again")
+        option = None
+    if option is not None:
+        print(f"Instruction classification reused from cache: option {option}")
+        return option
+
+    option = classify_instruction(instruction, options)
+    write_cache_file(cache_path, json.dumps({"option": option}))
+    return option
+
+
+def classify_instruction(instruction, options):
     client = get_openai_client()
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[
+
+    def validate(result):
+        if result["option"] not in options:
+            raise ValueError(f"unknown option {result['option']!r}")
+
+    def build(_, instruction):
+        return [
             {
                 "role": "user",
                 "content": f"You are a QMS expert. Analyze this instruction and choose the most appropriate option from: {options}. Respond in JSON format with the key 'option' and the value as the option number.",
             },
             {"role": "user", "content": f"Instruction: \n{instruction}"},
+        ]
+
+    response = complete_json(
+        client,
+        "classification",
+        validate=validate,
+        messages=fit_prompt("classification", build, None, instruction),
+    )
+    return response["option"]
+
+
+# Repository tree snapshots, shared by every code path for the run.
+# Keyed by (repo full name, ref) so each ref is resolved and listed once.
+_tree_snapshots = {}
+_tree_snapshots_lock = threading.Lock()
+_tree_snapshot_locks = {}
+
+
+def _walk_tree(repo, tree_sha, prefix, files):
+    # Fallback for truncated recursive trees: list this level only and
+    # descend into each subtree, retrying recursively per subtree first.
+    for element in repo.get_git_tree(tree_sha).tree:
+        path = f"{prefix}{element.path}"
+        if element.type == "blob":
+            files[path] = {"sha": element.sha, "size": element.size}
+        elif element.type == "tree":
+            subtree = repo.get_git_tree(element.sha, recursive=True)
+            if subtree.raw_data.get("truncated"):
+                _walk_tree(repo, element.sha, f"{path}/", files)
+            else:
+                for sub in subtree.tree:
+                    if sub.type == "blob":
+                        files[f"{path}/{sub.path}"] = {
+                            "sha": sub.sha,
+                            "size": sub.size,
+                        }
+
+
+def get_tree_snapshot(repo, ref="main"):
+    key = (repo.full_name, ref)
+    # One lock per repo and ref, so different repos are listed side by side
+    with _tree_snapshots_lock:
+        lock = _tree_snapshot_locks.setdefault(key, threading.Lock())
+    with lock:
+        snapshot = _tree_snapshots.get(key)
+        # Only matters for the batch worker, a one-shot run is far shorter
+        if snapshot and time.time() - snapshot["fetched_at"] < get_int_input(
+            "SNAPSHOT_TTL", 60
+        ):
+            return snapshot
+
+        with stage("listing"):
+            commit_sha = repo.get_branch(ref).commit.sha
+            tree = repo.get_git_tree(commit_sha, recursive=True)
+            files = {}
+            if tree.raw_data.get("truncated"):
+                print(f"Tree for {repo.full_name}@{ref} is truncated, walking subtrees")
+                _walk_tree(repo, tree.sha, "", files)
+            else:
+                for element in tree.tree:
+                    if element.type == "blob":
+                        files[element.path] = {"sha": element.sha, "size": element.size}
+
+        snapshot = {"commit_sha": commit_sha, "files": files, "fetched_at": time.time()}
+        _tree_snapshots[key] = snapshot
+        return snapshot
+
+
+def list_repo_files(repo, ref="main"):
+    return list(get_tree_snapshot(repo, ref)["files"])
+
+
+# On-disk blob cache shared across runs. Entries are named by their git blob
+# SHA, so a changed document simply misses and unchanged ones never refetch.
+_blob_cache_lock = threading.RLock()
+# Bytes in each cache directory, measured on its first eviction check
+_cache_bytes = {}
+# Held while a blob is fetched, so repositories sharing a document that are
+# processed side by side download it once
+_blob_fetch_locks = {}
+
+
+@contextlib.contextmanager
+def _blob_fetch_lock(sha):
+    # Entries are [lock, holders and waiters] and go once nobody needs them,
+    # so a long-running worker does not keep one lock per blob it ever read
+    with _blob_cache_lock:
+        entry = _blob_fetch_locks.setdefault(sha, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _blob_cache_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _blob_fetch_locks[sha]
+
+
+def get_runner_temp_dir():
+    # Outside the checkout, so run data is never committed or cached with it
+    return os.environ.get("RUNNER_TEMP") or tempfile.gettempdir()
+
+
+def get_blob_cache_dir():
+    return os.environ.get("INPUT_CACHE_DIR") or os.path.join(
+        get_runner_temp_dir(), "qms-cache"
+    )
+
+
+def read_cache_file(path):
+    """Return the text of a cache entry, or None when it is missing."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+    os.utime(path)
+    return text
+
+
+def write_cache_file(path, text):
+    """Replace a cache entry in one step, so readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    _evict_cache(path)
+
+
+def git_blob_sha(data):
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def _evict_cache(written):
+    """Keep the whole cache directory under the size limit after a write.
+
+    Blobs, HTTP responses, indexes, summaries, sections and classifications
+    share the one limit. The directory is only walked once its running total
+    goes over the limit.
+    """
+    cache_dir = get_blob_cache_dir()
+    max_bytes = get_int_input("CACHE_MAX_MB", 200) * 1024 * 1024
+    with _blob_cache_lock:
+        if cache_dir in _cache_bytes:
+            _cache_bytes[cache_dir] += os.path.getsize(written)
+            if _cache_bytes[cache_dir] <= max_bytes:
+                return
+        entries = []
+        for root, _, names in os.walk(cache_dir):
+            for name in names:
+                # Files still being written belong to another thread
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        # Least recently used first; hits refresh the mtime
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            # The file just written stays even when it alone exceeds the limit
+            if os.path.normpath(path) == os.path.normpath(written):
+                continue
+            os.remove(path)
+            total -= size
+        _cache_bytes[cache_dir] = total
+
+
+def read_blob(repo, sha):
+    with _blob_fetch_lock(sha):
+        cache_dir = get_blob_cache_dir()
+        path = os.path.join(cache_dir, sha)
+        with _blob_cache_lock:
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    data = f.read()
+                if git_blob_sha(data) == sha:
+                    os.utime(path)
+                    return data
+                print(f"Cached blob {sha} failed its integrity check, refetching")
+                os.remove(path)
+
+        with stage("fetch blob"):
+            data = base64.b64decode(repo.get_git_blob(sha).content)
+        if git_blob_sha(data) != sha:
+            raise ValueError(
+                f"Blob {sha} from {repo.full_name} failed its integrity check"
+            )
+
+        with _blob_cache_lock:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            _evict_cache(path)
+        return data
+
+
+def _file_blob_sha(path):
+    digest = hashlib.sha1(b"blob %d\0" % os.path.getsize(path))
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_blob_path(repo, sha):
+    """Return the path of blob ``sha`` in the on-disk cache.
+
+    The raw blob is streamed to disk in chunks, so it is neither limited by
+    the 1 MB inline content of the contents API nor held in memory whole.
+    """
+    with _blob_fetch_lock(sha):
+        cache_dir = get_blob_cache_dir()
+        path = os.path.join(cache_dir, sha)
+        with _blob_cache_lock:
+            if os.path.isfile(path):
+                if _file_blob_sha(path) == sha:
+                    os.utime(path)
+                    return path
+                print(f"Cached blob {sha} failed its integrity check, refetching")
+                os.remove(path)
+
+        # Blobs are only streamed from the QMS repositories
+        authorization = f"token {os.environ['INPUT_QMS_PAT']}"
+        limiter = get_github_rate_limiter(authorization)
+        url = f"{get_github_api_url()}/repos/{repo.full_name}/git/blobs/{sha}"
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        retries = get_int_input("RATE_LIMIT_RETRIES", 5)
+        with stage("fetch blob"):
+            for attempt in range(retries + 1):
+                limiter.acquire({"requests": 1})
+                with requests.get(
+                    url,
+                    headers={
+                        "Authorization": authorization,
+                        "Accept": "application/vnd.github.raw",
+                    },
+                    stream=True,
+                    timeout=get_int_input("GITHUB_TIMEOUT", 15),
+                ) as response:
+                    _add_metrics(github_calls=1)
+                    _update_github_rate_limiter(limiter, response.headers)
+                    if response.status_code == 200:
+                        with open(tmp_path, "wb") as f:
+                            for chunk in response.iter_content(64 * 1024):
+                                f.write(chunk)
+                        break
+                    delay = None
+                    if attempt < retries:
+                        delay = _github_retry_delay(
+                            response.status_code,
+                            response.headers,
+                            response.content,
+                            attempt,
+                        )
+                    if delay is None:
+                        response.raise_for_status()
+                        raise ValueError(f"Unexpected status {response.status_code}")
+                print(f"GitHub returned {response.status_code} for {url}, retrying")
+                _add_metrics(retries=1)
+                time.sleep(delay)
+
+        if _file_blob_sha(tmp_path) != sha:
+            os.remove(tmp_path)
+            raise ValueError(
+                f"Blob {sha} from {repo.full_name} failed its integrity check"
+            )
+        with _blob_cache_lock:
+            os.replace(tmp_path, path)
+            _evict_cache(path)
+        return path
+
+
+def _get_tree_entry(repo, file_path, ref):
+    entry = get_tree_snapshot(repo, ref)["files"].get(file_path)
+    if entry is None:
+        raise FileNotFoundError(f"{file_path} not found in {repo.full_name}@{ref}")
+    return entry
+
+
+def get_file_content(repo, file_path, ref="main"):
+    entry = _get_tree_entry(repo, file_path, ref)
+    return read_blob(repo, entry["sha"]).decode("utf-8")
+
+
+def get_file_path(repo, file_path, ref="main"):
+    """Like get_file_content, but returns the path of a local copy of the file."""
+    return get_blob_path(repo, _get_tree_entry(repo, file_path, ref)["sha"])
+
+
+# Local relevance index used to pre-select candidate files, so the file
+# selection prompt stays roughly the same size as the repository grows.
+INDEXED_EXTENSIONS = (".md", ".txt", ".json", ".yml", ".yaml", ".csv")
+# The most recent indexes, oldest first; the batch worker sees a new commit
+# with every change to a QMS repo
+_relevance_indexes = {}
+_relevance_indexes_lock = threading.Lock()
+RELEVANCE_INDEX_LIMIT = 8
+
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def document_headings(content):
+    return [
+        line.lstrip("#").strip()
+        for line in content.splitlines()
+        if re.match(r"#{1,3} ", line)
+    ]
+
+
+def _index_document(path, content):
+    tokens = tokenize(path.replace("/", " ").replace("-", " ")) + tokenize(content)
+    return {
+        "terms": dict(collections.Counter(tokens)),
+        "length": len(tokens),
+        "headings": document_headings(content),
+    }
+
+
+def _index_contents(repo, snapshot, paths):
+    """Index ``paths`` by path and content; large or binary files by path only."""
+    max_size = get_int_input("INDEX_MAX_FILE_KB", 512) * 1024
+    readable = [
+        path
+        for path in paths
+        if path.lower().endswith(INDEXED_EXTENSIONS)
+        and snapshot["files"][path]["size"] <= max_size
+    ]
+    results = run_concurrently(
+        [
+            lambda path=path: read_blob(repo, snapshot["files"][path]["sha"]).decode(
+                "utf-8", errors="replace"
+            )
+            for path in readable
         ],
-        response_format={"type": "json_object"},
+        get_int_input("HTTP_POOL_SIZE", 10),
     )
-    return json.loads(response.choices[0].message.content)["option"]
+    contents = {
+        path: content for path, (content, _) in zip(readable, results) if content
+    }
+    return {path: _index_document(path, contents.get(path, "")) for path in paths}
+
+
+def use_content_index():
+    # Reading every file only pays off when cache_dir is kept between jobs
+    return (os.environ.get("INPUT_INDEX_MODE") or "paths").lower() == "full"
 
 
-def list_repo_files(repo):
-    contents = repo.get_contents("")
-    file_list = []
-    while contents:
-        file_content = contents.pop(0)
-        if file_content.type == "dir":
-            contents.extend(repo.get_contents(file_content.path))
+@stage("relevance index")
+def get_relevance_index(repo, ref="main", content=None):
+    """Index every file of ``ref``, by path unless ``content`` or the index mode
+    asks for the file contents too."""
+    if content is None:
+        content = use_content_index()
+    snapshot = get_tree_snapshot(repo, ref)
+    key = (snapshot["commit_sha"], content)
+    with _relevance_indexes_lock:
+        if key in _relevance_indexes:
+            return _relevance_indexes[key]
+
+    if not content:
+        index = {path: _index_document(path, "") for path in snapshot["files"]}
+    else:
+        index_path = os.path.join(
+            get_blob_cache_dir(), "indexes", f"{snapshot['commit_sha']}.json"
+        )
+        cached = read_cache_file(index_path)
+        try:
+            index = json.loads(cached) if cached is not None else None
+        except ValueError:
+            print(f"Cached index {index_path} is unreadable, rebuilding it")
+            index = None
+        if not isinstance(index, dict):
+            index = _index_contents(repo, snapshot, list(snapshot["files"]))
+            write_cache_file(index_path, json.dumps(index))
+
+    with _relevance_indexes_lock:
+        _relevance_indexes[key] = index
+        while len(_relevance_indexes) > RELEVANCE_INDEX_LIMIT:
+            _relevance_indexes.pop(next(iter(_relevance_indexes)))
+    return index
+
+
+def rank_files(index, query, k1=1.5, b=0.75):
+    """Rank indexed documents against ``query`` with BM25.
+
+    Returns (key, score) tuples, best match first.
+    """
+    if not index:
+        return []
+    query_terms = set(tokenize(query))
+    n_docs = len(index)
+    avg_length = sum(doc["length"] for doc in index.values()) / n_docs or 1
+    doc_freq = collections.Counter(
+        term for doc in index.values() for term in query_terms & doc["terms"].keys()
+    )
+    scores = {
+        path: bm25_score(
+            doc["terms"], doc["length"], doc_freq, n_docs, avg_length, k1, b
+        )
+        for path, doc in index.items()
+    }
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+def bm25_score(terms, length, doc_freq, n_docs, avg_length, k1=1.5, b=0.75):
+    """BM25 score of one document; ``terms`` maps query terms to their counts."""
+    score = 0.0
+    for term, tf in terms.items():
+        if not tf or term not in doc_freq:
+            continue
+        idf = math.log(1 + (n_docs - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+        norm = tf + k1 * (1 - b + b * length / avg_length)
+        score += idf * tf * (k1 + 1) / norm
+    return score
+
+
+def select_candidate_files(repo, query, ref="main"):
+    index = get_relevance_index(repo, ref)
+    top_k = get_int_input("CANDIDATE_FILES", 20)
+    ranked = rank_files(index, query)
+    if not use_content_index():
+        # Only the best matches by path are read, then ranked on their content
+        pool_size = min(get_int_input("CANDIDATE_POOL", 40), len(ranked))
+        pool = [path for path, score in ranked[:pool_size] if score > 0]
+        if len(pool) < pool_size:
+            # Paths such as sops/SOP-042.md say nothing about the query, so
+            # the pool would be filled in name order; rank every file instead
+            print(f"Only {len(pool)} file paths match the query, reading all files")
+            index = get_relevance_index(repo, ref, content=True)
         else:
-            file_list.append(file_content.path)
-    return file_list
+            with stage("relevance index"):
+                index = _index_contents(repo, get_tree_snapshot(repo, ref), pool)
+        ranked = rank_files(index, query)
+    return {path: index[path]["headings"] for path, _ in ranked[:top_k]}
 
 
+@stage("llm file selection")
 def determine_files_to_update(files, instruction, issue_title, issue_body):
     client = get_openai_client()
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[
+
+    def build(files, issue_body):
+        # files maps candidate paths to their headings, best ranked first
+        candidates = "\n".join(
+            f"- {path}" + (f" (headings: {'; '.join(headings)})" if headings else "")
+            for path, headings in files.items()
+        )
+        return [
             {
                 "role": "user",
-                "content": f"You are a QMS expert. Given instruction, issue title and issue body, determine which files to update. Reply in JSON format. The key is 'files' and the value is a list of file paths. \n\n Instruction: {instruction}\n\n Issue Title: {issue_title}\n\n Issue Body: {issue_body} \n\n Files: {files}",
+                "content": f"You are a QMS expert. Given instruction, issue title and issue body, determine which files to update. Reply in JSON format. The key is 'files' and the value is a list of file paths. \n\n Instruction: {instruction}\n\n Issue Title: {issue_title}\n\n Issue Body: {issue_body} \n\n Files:\n{candidates}",
             }
-        ],
-        response_format={"type": "json_object"},
+        ]
+
+    def validate(result):
+        if not all(isinstance(path, str) for path in result["files"]):
+            raise ValueError("'files' is not a list of paths")
+
+    response = complete_json(
+        client,
+        "file selection",
+        validate=validate,
+        messages=fit_prompt("file selection", build, files, issue_body),
     )
-    response = json.loads(response.choices[0].message.content)
     print(f"Files to update: {response}")
-    return response["files"]
+    # Keep the ranking order, the outline prompt drops files from the end
+    selected = set(response["files"])
+    return [path for path in files if path in selected]
 
 
+@stage("llm PR summary")
 def summarize_pr(response_outline):
     client = get_openai_client()
-    messages = [
+
+    def build(_, outline):
+        return [
+            {
+                "role": "user",
+                "content": f"You are a QMS expert. Given the outline of the PR, summarize it and provide a title and body. Write it objectively, without mentioning LLM or AI. Respond in JSON format with keys 'title' and 'body'. Write the body in markdown format.",
+            },
+            {
+                "role": "user",
+                "content": f"Outline: {outline}",
+            },
+        ]
+
+    def validate(result):
+        if not isinstance(result["title"], str) or not isinstance(result["body"], str):
+            raise ValueError("'title' and 'body' must be strings")
+
+    return complete_json(
+        client,
+        "PR summary",
+        validate=validate,
+        messages=fit_prompt("PR summary", build, None, response_outline),
+    )
+
+
+@stage("commit files")
+def commit_files(repo, source_branch, branch, files, message):
+    """Commit several files on top of ``source_branch`` as a new ``branch``.
+
+    ``files`` maps paths to their new text content. The tree and commit are
+    built through the Git Data API and the branch is only created once they
+    exist, so a failed run leaves no branch behind and never a partial update.
+    """
+    parent = repo.get_git_commit(repo.get_branch(source_branch).commit.sha)
+    elements = [
+        InputGitTreeElement(path, "100644", "blob", content=content)
+        for path, content in files.items()
+    ]
+    tree = repo.create_git_tree(elements, base_tree=parent.tree)
+    commit = repo.create_git_commit(message, tree, [parent])
+    repo.create_git_ref(ref=f"refs/heads/{branch}", sha=commit.sha)
+    print(f"Committed {len(files)} file(s) to {branch}: {commit.sha}")
+    return commit.sha
+
+
+# Patch-based edits. The model returns anchored search/replace edits instead
+# of the full document, which keeps output tokens proportional to the change.
+SEARCH_REPLACE_INSTRUCTIONS = (
+    "Respond only with search/replace blocks in this exact format, one per change:\n"
+    "<<<<<<< SEARCH\n<exact lines copied from the current file>\n=======\n"
+    "<the lines that replace them>\n>>>>>>> REPLACE\n"
+    "Each SEARCH part must match the current file exactly and only once, so include "
+    "enough surrounding lines to make it unique. Do not add any other text."
+)
+
+
+class PatchConflict(Exception):
+    pass
+
+
+def get_edit_mode():
+    return (os.environ.get("INPUT_EDIT_MODE") or "patch").lower()
+
+
+def expect_search_replace(text):
+    stripped = text.lstrip()
+    marker = "<<<<<<< SEARCH"
+    if not marker.startswith(stripped[: len(marker)]):
+        raise GenerationAborted("output is not a search/replace block")
+    return len(stripped) >= len(marker)
+
+
+def parse_search_replace_blocks(text):
+    pattern = re.compile(
+        r"<<<<<<< SEARCH\n(.*?)\n=======\n(.*?)\n?>>>>>>> REPLACE", re.DOTALL
+    )
+    edits = [(match.group(1), match.group(2)) for match in pattern.finditer(text)]
+    if pattern.sub("", text).strip():
+        raise PatchConflict("output contains text outside search/replace blocks")
+    return edits
+
+
+def apply_edits(content, edits):
+    """Apply (search, replace) edits in order, each must match exactly once."""
+    for search, replace in edits:
+        count = content.count(search) if search else 0
+        if count != 1:
+            raise PatchConflict(
+                f"search text matches {count} times: {search[:60]!r}"
+                if search
+                else "empty search text"
+            )
+        content = content.replace(search, replace, 1)
+    return content
+
+
+def summarize_document(file_path, content):
+    headings = document_headings(content)[:8]
+    summary = f"{file_path} ({len(content.splitlines())} lines)"
+    return f"{summary}, sections: {'; '.join(headings)}" if headings else summary
+
+
+def build_file_update_messages(
+    instruction_messages, outline, originals, file_path, response_instructions
+):
+    """Assemble the prompt for updating a single file.
+
+    Everything up to the outline is identical for every file of the run, so
+    the provider can serve it from its prompt cache; only the file being
+    edited is sent in full, the others as one-line summaries.
+    """
+    return instruction_messages + [
         {
             "role": "user",
-            "content": f"You are a QMS expert. Given the outline of the PR, summarize it and provide a title and body. Write it objectively, without mentioning LLM or AI. Respond in JSON format with keys 'title' and 'body'. Write the body in markdown format.",
+            "content": "Files in this update:\n"
+            + "\n".join(
+                f"- {summarize_document(path, content)}"
+                for path, content in originals.items()
+            ),
         },
+        {"role": "assistant", "content": outline},
         {
             "role": "user",
-            "content": f"Outline: {response_outline}",
+            "content": f"File: {file_path} \n File content:\n{originals[file_path]}",
+        },
+        {
+            "role": "user",
+            "content": f"Now update this file: {file_path} according to your own outline. {response_instructions}",
         },
     ]
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=messages,
-        response_format={"type": "json_object"},
-    )
-    return json.loads(response.choices[0].message.content)
 
 
 def update_files(
     repo, source_branch, target_branch, files, issue_title, issue_body, instruction
 ):
     client = get_openai_client()
-    messages = [
-        {
-            "role": "user",
-            "content": f"You are a QMS expert. Given instruction, issue title, issue body and the files to be updated, outline how you would update the files.",
-        },
-        {
-            "role": "user",
-            "content": f"Instruction: {instruction}\n\n Issue Title: {issue_title}\n\n Issue Body: {issue_body}",
-        },
-    ]
-    for file_path in files:
-        file_content = repo.get_contents(file_path, ref=target_branch)
-        decoded_content = base64.b64decode(file_content.content).decode("utf-8")
-        messages.append(
+
+    def instruction_messages(issue_body):
+        return [
             {
                 "role": "user",
-                "content": f"File: {file_path} \n File content:\n{decoded_content}",
-            }
-        )
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=messages,
-        response_format={"type": "text"},
-    )
-    response_outline = response.choices[0].message.content
-    response_summary = summarize_pr(response_outline)
+                "content": f"You are a QMS expert. Given instruction, issue title, issue body and the files to be updated, outline how you would update the files.",
+            },
+            {
+                "role": "user",
+                "content": f"Instruction: {instruction}\n\n Issue Title: {issue_title}\n\n Issue Body: {issue_body}",
+            },
+        ]
 
-    messages.append({"role": "assistant", "content": response_outline})
-    i = 0
-    for file_path in files:
-        if i != 0:
-            messages.pop()
-        messages.append(
+    with stage("fetch files"):
+        originals = {}
+        for file_path in files:
+            file_content = repo.get_contents(file_path, ref=source_branch)
+            decoded_content = base64.b64decode(file_content.content).decode("utf-8")
+            originals[file_path] = decoded_content
+
+    def build_outline_messages(included, issue_body):
+        # Files dropped to fit the budget are only described
+        return instruction_messages(issue_body) + [
             {
                 "role": "user",
-                "content": f"Now update this file: {file_path} according to your own outline. Respond with just the full updated contents of the file, keeping original formatting.",
+                "content": (
+                    f"File: {file_path} \n File content:\n{content}"
+                    if file_path in included
+                    else f"File: {summarize_document(file_path, content)}, content not shown"
+                ),
             }
+            for file_path, content in originals.items()
+        ]
+
+    def build_messages(file_path, response_instructions):
+        return fit_prompt(
+            "file update",
+            lambda _, issue_body: build_file_update_messages(
+                instruction_messages(issue_body),
+                response_outline,
+                originals,
+                file_path,
+                response_instructions,
+            ),
+            issue_body=issue_body,
         )
-        response = client.chat.completions.create(
-            model=MODEL,
+
+    # Every file is still sent in full to its own update call
+    messages = fit_prompt(
+        "outline", build_outline_messages, originals, issue_body, keep_files=0
+    )
+    # Repositories given the same files get the same outline and edits
+    response_outline = run_shared(
+        ("outline", messages),
+        lambda: stream_completion(
+            client,
+            "Update outline",
+            model=get_model("outline"),
             messages=messages,
             response_format={"type": "text"},
-        )
-        response_content = response.choices[0].message.content
-        file_content = repo.get_contents(file_path, ref=target_branch)
-        repo.update_file(
+        ),
+    )
+
+    def generate_file(file_path):
+        if get_edit_mode() == "patch":
+            try:
+                output = stream_completion(
+                    client,
+                    file_path,
+                    validate=expect_search_replace,
+                    model=get_model("file update"),
+                    messages=build_messages(file_path, SEARCH_REPLACE_INSTRUCTIONS),
+                    response_format={"type": "text"},
+                )
+                return apply_edits(
+                    originals[file_path], parse_search_replace_blocks(output)
+                )
+            except (GenerationAborted, PatchConflict) as e:
+                print(f"{file_path}: patch not applied ({e}), regenerating the file")
+
+        return stream_completion(
+            client,
             file_path,
-            f"Update {file_path}",
-            response_content,
-            file_content.sha,
-            branch=target_branch,
+            validate=reject_code_fence,
+            model=get_model("file update"),
+            messages=build_messages(
+                file_path,
+                "Respond with just the full updated contents of the file, keeping original formatting.",
+            ),
+            response_format={"type": "text"},
         )
-        i += 1
 
-    # Create a pull request
-    pr = repo.create_pull(
-        title=response_summary["title"],
-        body=response_summary["body"],
-        head=target_branch,
-        base=source_branch,
+    # The PR summary and every file only depend on the outline, so generate
+    # them side by side and commit the files together once all succeeded.
+    results = run_concurrently(
+        [
+            lambda: run_shared(
+                ("PR summary", response_outline),
+                lambda: summarize_pr(response_outline),
+            )
+        ]
+        + [
+            lambda file_path=file_path: run_shared(
+                (
+                    "file update",
+                    get_edit_mode(),
+                    messages[:2],
+                    response_outline,
+                    originals,
+                    file_path,
+                ),
+                lambda: generate_file(file_path),
+            )
+            for file_path in files
+        ],
+        get_int_input("FILE_WORKERS", 4),
     )
+    errors = [
+        (name, error)
+        for name, (_, error) in zip(["PR summary"] + files, results)
+        if error is not None
+    ]
+    if errors:
+        for name, error in errors:
+            print(f"Error: Failed to generate {name}: {error}")
+        print(f"Branch {target_branch} not created")
+        return None
+
+    response_summary = results[0][0]
+    commit_files(
+        repo,
+        source_branch,
+        target_branch,
+        {file_path: content for file_path, (content, _) in zip(files, results[1:])},
+        response_summary["title"],
+    )
+
+    # Create a pull request
+    with stage("create pull request"):
+        pr = repo.create_pull(
+            title=response_summary["title"],
+            body=response_summary["body"],
+            head=target_branch,
+            base=source_branch,
+        )
     return pr.html_url
 
 
 def update_qms(target_repo, instruction, issue_title, issue_body, issue_url):
     g = get_github_qms_client()
     repo = g.get_repo(target_repo)
-    files = list_repo_files(repo)
-    print("Files in the repository:")
-    for file in files:
-        print(f"- {file}")
     print(f"Successfully connected to Github, and repo: {repo}")
     print(f"Instruction: {instruction}")
+    files = select_candidate_files(
+        repo, f"{instruction}\n{issue_title}\n{issue_body or ''}"
+    )
+    print("Candidate files in the repository:")
+    for file in files:
+        print(f"- {file}")
 
-    files_to_update = determine_files_to_update(
-        files, instruction, issue_title, issue_body
+    files_to_update = run_shared(
+        ("file selection", files, instruction, issue_title, issue_body),
+        lambda: determine_files_to_update(files, instruction, issue_title, issue_body),
     )
 
-    # Create a new branch
+    # The branch is created by update_files once every file is generated
     source_branch = "main"
     target_branch = f"update-{issue_title.replace(' ', '-').replace('/', '-')}"
-    sb = repo.get_branch(source_branch)
 
     # Check if the target branch already exists
     try:
@@ -185,8 +1912,7 @@ def update_qms(target_repo, instruction, issue_title, issue_body, issue_url):
         print(f"Branch {target_branch} already exists. Exiting.")
         return None
     except:
-        # Branch doesn't exist, so we can create it
-        repo.create_git_ref(ref=f"refs/heads/{target_branch}", sha=sb.commit.sha)
+        pass
 
     pr_url = update_files(
         repo,
@@ -209,60 +1935,190 @@ def find_change_request_template(files):
 
 
 def get_latest_cr_number(repo):
-    try:
-        contents = repo.get_contents("change-requests/change-request-records")
-        cr_numbers = []
-        for content in contents:
-            if content.type == "file" and content.name.startswith("CR"):
-                try:
-                    number = int(content.name.split("-")[0][2:])
-                    cr_numbers.append(number)
-                except ValueError:
-                    continue
-        return max(cr_numbers) if cr_numbers else 0
-    except:
-        return 0
+    cr_numbers = [0]
+    for path in list_repo_files(repo):
+        directory, _, name = path.rpartition("/")
+        if directory == CR_RECORDS_DIR and name.startswith("CR"):
+            try:
+                cr_numbers.append(int(name.split("-")[0][2:]))
+            except ValueError:
+                continue
+    return max(cr_numbers)
+
+
+# Each filled section of a change request record starts with a marker holding
+# a hash of the inputs it was generated from, so later runs only regenerate
+# sections whose inputs changed. Inputs are looked up by the section's major
+# number; unknown sections depend on everything.
+SECTION_MARKER = "<!--qms-cr-section:{index} {inputs_hash}-->"
+SECTION_MARKER_PATTERN = re.compile(r"<!--qms-cr-section:(\d+) (\w+)-->\n?")
+SECTION_INPUTS = {
+    1: (),
+    2: ("issue_body", "issue_url", "pr_url"),
+    3: ("issue_body", "pr_body"),
+    4: ("issue_title", "issue_body", "pr_title", "pr_body"),
+    5: ("issue_body",),
+    6: ("issue_body",),
+    7: ("issue_body", "pr_body"),
+    8: ("issue_body", "pr_body"),
+    9: ("issue_body",),
+    10: ("issue_body",),
+}
+ALL_SECTION_INPUTS = (
+    "issue_title",
+    "issue_body",
+    "issue_url",
+    "pr_title",
+    "pr_body",
+    "pr_url",
+)
+
+
+def split_template_sections(template_content):
+    # Split template into sections based on ## headers
+    sections = re.split(r"(?m)^## ", template_content)
+    header = sections[0]  # Contains the # Change Request Form
+    return header.strip("\n"), ["## " + s for s in sections[1:]]
 
 
-def create_change_control_record(
-    repo, instruction, issue_title, issue_body, issue_url, pr_title, pr_body, pr_url
-):
-    client = get_openai_client()
-    files = list_repo_files(repo)
+def is_revision_log_section(section):
+    return "revision" in section.split("\n")[0].lower()
 
-    template_file = find_change_request_template(files)
-    if not template_file:
-        print("Error: change-request-template.md not found")
+
+def section_input_hash(section, context):
+    match = re.match(r"## (\d+)", section)
+    fields = SECTION_INPUTS.get(int(match.group(1))) if match else None
+    if is_revision_log_section(section):
+        # Only rewritten when another section changes
+        fields = ()
+    elif fields is None:
+        fields = ALL_SECTION_INPUTS
+    key = json.dumps([section, [context.get(field) or "" for field in fields]])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def parse_record_sections(record):
+    """Split a record into its header and [(index, inputs_hash, text)]."""
+    parts = SECTION_MARKER_PATTERN.split(record)
+    if len(parts) < 4:
         return None
+    sections = [
+        (int(parts[i]), parts[i + 1], parts[i + 2].strip("\n"))
+        for i in range(1, len(parts), 3)
+    ]
+    return parts[0].strip("\n"), sections
 
-    template_content = repo.get_contents(template_file).decoded_content.decode("utf-8")
-    today = datetime.datetime.now().strftime("%Y-%b-%d")
 
-    # Split template into sections based on ## headers
-    sections = re.split(r"(?m)^## ", template_content)
-    header = sections[0]  # Contains the # Change Request Form
-    sections = ["## " + s for s in sections[1:]]  # Add back the ## to other sections
-    i = 0
+def join_record_sections(header, sections):
+    return "\n\n".join(
+        [header]
+        + [
+            SECTION_MARKER.format(index=index, inputs_hash=inputs_hash) + "\n" + text
+            for index, inputs_hash, text in sections
+        ]
+    )
 
-    filled_sections = [header]
-    base_context = {
-        "issue_title": issue_title,
-        "issue_body": issue_body,
-        "issue_url": issue_url,
-        "pr_title": pr_title,
-        "pr_body": pr_body,
-        "pr_url": pr_url,
-        "today": today,
-    }
 
-    for section in sections:
-        i += 1
-        section_title = section.split("\n")[0]
+def _section_cache_path(inputs_hash):
+    return os.path.join(get_blob_cache_dir(), "sections", inputs_hash)
+
+
+def read_cached_section(inputs_hash):
+    # An empty entry is what an interrupted write leaves behind
+    return read_cache_file(_section_cache_path(inputs_hash)) or None
+
+
+def write_cached_section(inputs_hash, content):
+    write_cache_file(_section_cache_path(inputs_hash), content)
+
+
+CR_RECORDS_DIR = "change-request-records"
+CR_COUNTER_PATH = "change-requests/cr-counter.json"
+# The counter is committed to a branch of its own, so main can stay protected
+CR_COUNTER_BRANCH = "cr-counter"
+
+
+def _ensure_counter_branch(repo):
+    try:
+        repo.get_branch(CR_COUNTER_BRANCH)
+    except GithubException as e:
+        # GitHub answers "Branch not found", which PyGithub does not map
+        # to UnknownObjectException
+        if e.status != 404:
+            raise
+        try:
+            repo.create_git_ref(
+                ref=f"refs/heads/{CR_COUNTER_BRANCH}",
+                sha=repo.get_branch("main").commit.sha,
+            )
+        except GithubException as e:
+            # Created by a concurrent run in the meantime
+            if e.status != 422:
+                raise
+
+
+def _is_stale_sha_error(e):
+    """Whether a contents API write failed only because the file moved on."""
+    message = e.data.get("message", "") if isinstance(e.data, dict) else ""
+    if e.status == 409:
+        return "does not match" in message or "but expected" in message
+    return e.status == 422 and "wasn't supplied" in message
+
+
+@stage("allocate CR number")
+def allocate_cr_number(repo):
+    """Reserve the next change request number.
+
+    The last issued number lives in a small counter file that is updated
+    with its blob SHA as precondition, so concurrent runs cannot hand out
+    the same number; the loser of a race re-reads the counter and retries.
+    Any other rejection of the write is raised. Records already on main
+    always count, so a counter that fell behind them cannot reissue a number.
+    """
+    _ensure_counter_branch(repo)
+    attempts = get_int_input("CR_ALLOCATION_RETRIES", 5) + 1
+    for attempt in range(1, attempts + 1):
+        try:
+            counter = repo.get_contents(CR_COUNTER_PATH, ref=CR_COUNTER_BRANCH)
+            last_number = json.loads(counter.decoded_content)["last"]
+        except UnknownObjectException:
+            # First allocation in this repo
+            counter = None
+            last_number = 0
+
+        number = max(last_number, get_latest_cr_number(repo)) + 1
+        content = json.dumps({"last": number}) + "\n"
+        message = f"Allocate change request number CR{number:03d}"
+        try:
+            if counter is None:
+                repo.create_file(
+                    CR_COUNTER_PATH, message, content, branch=CR_COUNTER_BRANCH
+                )
+            else:
+                repo.update_file(
+                    CR_COUNTER_PATH,
+                    message,
+                    content,
+                    counter.sha,
+                    branch=CR_COUNTER_BRANCH,
+                )
+            return number
+        except GithubException as e:
+            if not _is_stale_sha_error(e) or attempt == attempts:
+                raise
+            print(f"CR{number:03d} was taken concurrently, retrying ({attempt})")
+            time.sleep(random.uniform(0, 0.5 * attempt))
+
+
+def fill_change_request_section(section, template_content, context, current=None):
+    client = get_openai_client()
+    section_title = section.split("\n")[0]
 
+    def build(_, issue_body):
         messages = [
             {
                 "role": "system",
-                "content": f"You are a QMS expert. Fill out this section of the change request template based on the provided information. Only fill out information you can confidently determine from the context. Do not restructure, but stick to the provided template. Your job is to fill it out, nothing else. Do not include any markdown tags like ```markdown, but only markdown formatting on the text itself.Today is {today}.",
+                "content": f"You are a QMS expert. Fill out this section of the change request template based on the provided information. Only fill out information you can confidently determine from the context. Do not restructure, but stick to the provided template. Your job is to fill it out, nothing else. Do not include any markdown tags like ```markdown, but only markdown formatting on the text itself.Today is {context['today']}.",
             },
             {
                 "role": "user",
@@ -283,33 +2139,119 @@ def create_change_control_record(
             {
                 "role": "user",
                 "content": f"Full template:\n {template_content}\n\nContext:\n"
-                f"Issue Title: {issue_title}\n"
+                f"Issue Title: {context['issue_title']}\n"
                 f"Issue Body: {issue_body}\n"
-                f"Issue URL: {issue_url}\n"
-                f"PR Title: {pr_title}\n"
-                f"PR Body: {pr_body}\n"
-                f"PR URL: {pr_url}\n\n"
+                f"Issue URL: {context['issue_url']}\n"
+                f"PR Title: {context['pr_title']}\n"
+                f"PR Body: {context['pr_body']}\n"
+                f"PR URL: {context['pr_url']}\n\n"
                 f"Only respond with the filled section in markdown format, no other text.",
             },
         ]
+        if current is not None:
+            messages.append(
+                {
+                    "role": "user",
+                    "content": f"This section has already been filled in the change request record as follows:\n{current}\n\nKeep what is still correct, fill in TBD fields and update fields for which the context now has new information.",
+                }
+            )
+        return messages
 
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            response_format={"type": "text"},
-            temperature=0.2,
+    messages = fit_prompt(
+        "change request section", build, issue_body=context["issue_body"]
+    )
+
+    attempts = get_int_input("SECTION_RETRIES", 2) + 1
+    timeout = get_int_input("SECTION_TIMEOUT", 120)
+    for attempt in range(1, attempts + 1):
+        try:
+            return stream_completion(
+                client,
+                section_title,
+                validate=reject_code_fence,
+                timeout=timeout,
+                model=get_model("change request section"),
+                messages=messages,
+                response_format={"type": "text"},
+                temperature=0.2,
+            )
+        except Exception as e:
+            print(f"Section {section_title} failed (attempt {attempt}/{attempts}): {e}")
+            if attempt == attempts:
+                raise
+
+
+def create_change_control_record(
+    repo, instruction, issue_title, issue_body, issue_url, pr_title, pr_body, pr_url
+):
+    files = list_repo_files(repo)
+
+    template_file = find_change_request_template(files)
+    if not template_file:
+        print("Error: change-request-template.md not found")
+        return None
+
+    template_content = get_file_content(repo, template_file)
+    today = datetime.datetime.now().strftime("%Y-%b-%d")
+
+    header, sections = split_template_sections(template_content)
+
+    base_context = {
+        "issue_title": issue_title,
+        "issue_body": issue_body,
+        "issue_url": issue_url,
+        "pr_title": pr_title,
+        "pr_body": pr_body,
+        "pr_url": pr_url,
+        "today": today,
+    }
+
+    # Sections generated earlier from the same inputs are reused as they are
+    hashes = [section_input_hash(section, base_context) for section in sections]
+    cached = [read_cached_section(inputs_hash) for inputs_hash in hashes]
+    results = iter(
+        run_concurrently(
+            [
+                lambda section=section: fill_change_request_section(
+                    section, template_content, base_context
+                )
+                for section, content in zip(sections, cached)
+                if content is None
+            ],
+            get_int_input("SECTION_WORKERS", 4),
         )
+    )
+    results = [
+        (content, None) if content is not None else next(results) for content in cached
+    ]
 
-        filled_sections.append(response.choices[0].message.content)
-        print(f"Appending the filled section: {response.choices[0].message.content}")
+    filled_sections = []
+    failed_sections = []
+    for index, (section, inputs_hash, (content, error)) in enumerate(
+        zip(sections, hashes, results), start=1
+    ):
+        if error is None:
+            write_cached_section(inputs_hash, content)
+            filled_sections.append((index, inputs_hash, content))
+            print(f"Appending the filled section: {content}")
+        else:
+            # Keep the unfilled template section so the record stays complete;
+            # its pending hash makes the next update regenerate it
+            failed_sections.append(section.split("\n")[0])
+            filled_sections.append((index, "pending", section))
         print("--------------------------------")
 
+    if failed_sections and len(failed_sections) == len(sections):
+        print("Error: Could not fill any section of the change request template")
+        return None
+    if failed_sections:
+        print(f"Warning: Sections left unfilled: {', '.join(failed_sections)}")
+
     # Combine all sections
-    filled_template = "\n\n".join(filled_sections)
+    filled_template = join_record_sections(header, filled_sections)
 
     # Rest of the function remains the same
-    latest_cr_number = get_latest_cr_number(repo)
-    new_cr_number = latest_cr_number + 1
+    new_cr_number = allocate_cr_number(repo)
     summary = issue_title[:50]
     filename = f"CR{new_cr_number:03d}-{summary}"
     filename = re.sub(r"[^\w\-_\. ]", "_", filename)
@@ -318,6 +2260,121 @@ def create_change_control_record(
     return filename, filled_template, summary
 
 
+def add_revision_log_entry(section, changed_titles, today):
+    client = get_openai_client()
+    return stream_completion(
+        client,
+        section.split("\n")[0],
+        validate=reject_code_fence,
+        model=get_model("revision log"),
+        # The log is returned whole, so there is nothing to compact
+        messages=fit_prompt(
+            "revision log",
+            lambda _, __: [
+                {
+                    "role": "system",
+                    "content": f"You are a QMS expert. Add exactly one entry to the revision log of a change request record describing which sections were updated. Keep the existing entries and formatting unchanged. Do not include any markdown tags like ```markdown. Today is {today}.",
+                },
+                {
+                    "role": "user",
+                    "content": f"Revision log section:\n{section}\n\nSections updated in this revision: {', '.join(changed_titles)}\n\nOnly respond with the full revision log section in markdown format, no other text.",
+                },
+            ],
+        ),
+        response_format={"type": "text"},
+        temperature=0.2,
+    )
+
+
+@stage("llm change control summary")
+def summarize_change_control(context):
+    client = get_openai_client()
+
+    def build(_, issue_body):
+        return [
+            {
+                "role": "user",
+                "content": f"You are a QMS expert. Write a summary of the entire issue and PR, formatted in markdown to serve as the body of the change control PR. Only respond with the summary.\n\nIssue Title: {context['issue_title']}\n\nIssue Body: {issue_body}\n\nIssue URL: {context['issue_url']}\n\nPR Title: {context['pr_title']}\n\nPR Body: {context['pr_body']}\n\nPR URL: {context['pr_url']}",
+            }
+        ]
+
+    response = client.chat.completions.create(
+        model=get_model("change control summary"),
+        messages=fit_prompt(
+            "change control summary", build, issue_body=context["issue_body"]
+        ),
+        response_format={"type": "text"},
+    )
+    record_usage(response.usage, response.model)
+    return response.choices[0].message.content
+
+
+def update_record_sections(repo, record, context):
+    """Regenerate only the record sections whose inputs changed.
+
+    Returns the updated record, or None if the record carries no section
+    markers or no longer lines up with the template.
+    """
+    parsed = parse_record_sections(record)
+    template_file = find_change_request_template(list_repo_files(repo))
+    if parsed is None or not template_file:
+        return None
+    header, record_sections = parsed
+    template_content = get_file_content(repo, template_file)
+    _, template_sections = split_template_sections(template_content)
+    if len(template_sections) != len(record_sections):
+        return None
+
+    hashes = [section_input_hash(section, context) for section in template_sections]
+    changed = [
+        i
+        for i, section in enumerate(template_sections)
+        if hashes[i] != record_sections[i][1] and not is_revision_log_section(section)
+    ]
+    print(f"{len(changed)} of {len(template_sections)} sections have new inputs")
+    if not changed:
+        return record
+
+    results = run_concurrently(
+        [
+            lambda i=i: fill_change_request_section(
+                template_sections[i],
+                template_content,
+                context,
+                current=record_sections[i][2],
+            )
+            for i in changed
+        ],
+        get_int_input("SECTION_WORKERS", 4),
+    )
+    sections = list(record_sections)
+    updated_titles = []
+    for i, (content, error) in zip(changed, results):
+        title = template_sections[i].split("\n")[0]
+        if error is None:
+            sections[i] = (sections[i][0], hashes[i], content)
+            updated_titles.append(title)
+        else:
+            print(f"Warning: Section {title} not updated: {error}")
+
+    revision = next(
+        (
+            i
+            for i, section in enumerate(template_sections)
+            if is_revision_log_section(section)
+        ),
+        None,
+    )
+    if updated_titles and revision is not None:
+        index, _, text = sections[revision]
+        sections[revision] = (
+            index,
+            hashes[revision],
+            add_revision_log_entry(text, updated_titles, context["today"]),
+        )
+    return join_record_sections(header, sections)
+
+
 def update_change_control_record(
     repo, cc_url, issue_title, issue_body, issue_url, pr_title, pr_body, pr_url
 ):
@@ -335,7 +2392,7 @@ def update_change_control_record(
         (
             file
             for file in files_changed
-            if file.filename.startswith("change-request-records/CR")
+            if file.filename.startswith(f"{CR_RECORDS_DIR}/CR")
         ),
         None,
     )
@@ -345,39 +2402,98 @@ def update_change_control_record(
         return None
 
     # Get the content of the file
-    file_content = repo.get_contents(
-        cr_file.filename, ref=pr.head.ref
-    ).decoded_content.decode("utf-8")
+    with stage("fetch change control record"):
+        file_content = repo.get_contents(
+            cr_file.filename, ref=pr.head.ref
+        ).decoded_content.decode("utf-8")
 
     today = datetime.datetime.now().strftime("%Y-%b-%d")
 
-    messages = [
-        {
-            "role": "system",
-            "content": f"You are a QMS expert. Update the change request record based on the provided information. Focus on filling in TBD fields, but also update other fields if new information is available. Always incrementally update the revisio log with your changes. Today is {today}.",
-        },
-        {
-            "role": "user",
-            "content": f"Current change request record:\n{file_content}\n\nIssue Title: {issue_title}\n\nIssue Body: {issue_body}\n\nIssue URL: {issue_url}\n\nPR Title: {pr_title}\n\nPR Body: {pr_body}\n\nPR URL: {pr_url}\n\nRespond in json format with keys 'updated_content' and 'summary' with the updated record in markdown format, followed by a summary of entire issue+PR, also formatted in markdown to serve as the PR body..",
-        },
-    ]
-
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=messages,
-        response_format={"type": "json_object"},
-    )
+    system_prompt = f"You are a QMS expert. Update the change request record based on the provided information. Focus on filling in TBD fields, but also update other fields if new information is available. Always incrementally update the revisio log with your changes. Today is {today}."
+
+    def record_prompt(issue_body):
+        return f"Current change request record:\n{file_content}\n\nIssue Title: {issue_title}\n\nIssue Body: {issue_body}\n\nIssue URL: {issue_url}\n\nPR Title: {pr_title}\n\nPR Body: {pr_body}\n\nPR URL: {pr_url}\n\n"
+
+    full_instructions = "Respond in json format with keys 'updated_content' and 'summary' with the updated record in markdown format, followed by a summary of entire issue+PR, also formatted in markdown to serve as the PR body.."
+    patch_instructions = "Respond in json format with keys 'edits' and 'summary'. 'edits' is a list of objects with keys 'search' and 'replace': 'search' is text copied exactly from the current record that occurs only once in it (include enough surrounding text to make it unique), 'replace' is the text that replaces it. 'summary' is a summary of entire issue+PR, formatted in markdown to serve as the PR body."
+
+    def request_update(instructions):
+        return json.loads(
+            stream_completion(
+                client,
+                cr_file.filename,
+                validate=expect_json_object,
+                model=get_model("change control record"),
+                messages=fit_prompt(
+                    "change control record",
+                    lambda _, body: [
+                        {"role": "system", "content": system_prompt},
+                        {
+                            "role": "user",
+                            "content": record_prompt(body) + instructions,
+                        },
+                    ],
+                    issue_body=issue_body,
+                ),
+                response_format={"type": "json_object"},
+            )
+        )
 
-    response_content = json.loads(response.choices[0].message.content)
+    context = {
+        "issue_title": issue_title,
+        "issue_body": issue_body,
+        "issue_url": issue_url,
+        "pr_title": pr_title,
+        "pr_body": pr_body,
+        "pr_url": pr_url,
+        "today": today,
+    }
+    updated_content = update_record_sections(repo, file_content, context)
+    if updated_content == file_content:
+        print("Change control record is up to date")
+        return pr_url
+
+    if updated_content is not None:
+        response_content = {
+            "updated_content": updated_content,
+            "summary": summarize_change_control(context),
+        }
+    else:
+        # Records without section markers are updated as a whole
+        response_content = None
+        if get_edit_mode() == "patch":
+            try:
+                response_content = request_update(patch_instructions)
+                response_content["updated_content"] = apply_edits(
+                    file_content,
+                    [
+                        (edit["search"], edit["replace"])
+                        for edit in response_content["edits"]
+                    ],
+                )
+            except (
+                GenerationAborted,
+                PatchConflict,
+                KeyError,
+                TypeError,
+                ValueError,
+            ) as e:
+                print(
+                    f"{cr_file.filename}: patch not applied ({e}), regenerating the record"
+                )
+                response_content = None
+        if response_content is None:
+            response_content = request_update(full_instructions)
 
     # Update the file in the PR branch
-    repo.update_file(
-        cr_file.filename,
-        f"Update {cr_file.filename}",
-        response_content["updated_content"],
-        repo.get_contents(cr_file.filename, ref=pr.head.ref).sha,
-        branch=pr.head.ref,
-    )
+    with stage("commit change control record"):
+        repo.update_file(
+            cr_file.filename,
+            f"Update {cr_file.filename}",
+            response_content["updated_content"],
+            repo.get_contents(cr_file.filename, ref=pr.head.ref).sha,
+            branch=pr.head.ref,
+        )
 
     # Update PR body
     updated_pr_body = f"{response_content['summary']}"
@@ -386,6 +2502,7 @@ def update_change_control_record(
     return pr_url
 
 
+@stage("create change control PR")
 def create_pr_for_change_control(repo, filename, content, summary):
     # Create a new branch
     source_branch = "main"
@@ -395,7 +2512,7 @@ def create_pr_for_change_control(repo, filename, content, summary):
 
     # Create the file in the new branch
     repo.create_file(
-        f"change-request-records/{filename}",
+        f"{CR_RECORDS_DIR}/{filename}",
         f"Create Change Request {filename.split('-')[0]}",
         content,
         branch=target_branch,
@@ -411,43 +2528,253 @@ def create_pr_for_change_control(repo, filename, content, summary):
     return pr.html_url
 
 
-def get_design_matrix_content():
-    g = get_github_qms_client()
-    qms_repo = g.get_repo("seespine-2022/qms-docs")
-    file_path = "design/design-matrix/design-matrix.json"
+QMS_DOCS_REPO = "seespine-2022/qms-docs"
+DESIGN_MATRIX_PATH = "design/design-matrix/design-matrix.json"
+FMEA_PATH = "risk/fmea/fmea.json"
 
-    try:
-        file_content = qms_repo.get_contents(file_path, ref="main")
-        decoded_content = base64.b64decode(file_content.content).decode("utf-8")
-        return decoded_content
-    except Exception as e:
-        print(f"Error: Unable to get contents of {file_path}. Exception: {e}")
-        sys.exit(1)
-        return None
 
+def get_qms_docs_repo(target_repo):
+    """Return the repository holding the DTM and FMEA for ``target_repo``."""
+    docs_repo = os.environ.get("INPUT_QMS_DOCS_REPO") or QMS_DOCS_REPO
+    # "target" reads the documents of each target repository
+    return target_repo if docs_repo == "target" else docs_repo
 
-def get_fmea_content():
+
+def get_qms_document_path(docs_repo, file_path):
+    """Return the path of a local copy of a QMS docs JSON document."""
     g = get_github_qms_client()
-    qms_repo = g.get_repo("seespine-2022/qms-docs")
-    file_path = "risk/fmea/fmea.json"
+    qms_repo = g.get_repo(docs_repo)
     print("Repo: ", qms_repo)
 
     try:
-        file_content = qms_repo.get_contents(file_path, ref="main")
-        decoded_content = base64.b64decode(file_content.content).decode("utf-8")
-        print("FMEA content: ", decoded_content)
-        return decoded_content
+        return get_file_path(qms_repo, file_path)
     except Exception as e:
         print(f"Error: Unable to get contents of {file_path}. Exception: {e}")
-        sys.exit(1)
+        raise
+
+
+# Structured retrieval over the DTM and FMEA. Instead of the whole JSON
+# document, prompts get a schema summary, every record ID and the records
+# relevant to the issue.
+def _record_id(record, position):
+    # Matches "id", "ID", "fm_id", "Failure Mode ID" and camelCase "needId"
+    for key, value in record.items():
+        if re.fullmatch(r"(?i:id|.*[_\s-]id)|.*[a-z]Id", key):
+            if isinstance(value, (str, int)):
+                return str(value)
+    return position
+
+
+class _JsonReader:
+    """Reads a JSON document from a file one token or value at a time."""
+
+    def __init__(self, f, chunk_size=64 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def take(self, expected):
+        if self.peek() != expected:
+            raise ValueError(
+                f"expected {expected!r} at {self.buffer[self.pos:][:20]!r}"
+            )
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number running up to the end of the buffer may continue in
+            # the next chunk
+            if (
+                isinstance(value, (int, float))
+                and not isinstance(value, bool)
+                and re.fullmatch(r"[\d.eE+-]*", self.buffer[end:])
+                and self._fill()
+            ):
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_records(reader, location="$"):
+    """Yield (location, position, record) for each object in a list of objects.
+
+    Only the record being yielded is held in memory, so documents of any size
+    can be scanned.
+    """
+    char = reader.peek()
+    if char == "{":
+        reader.take("{")
+        while reader.peek() != "}":
+            key = reader.value()
+            reader.take(":")
+            yield from iter_json_records(reader, f"{location}.{key}")
+            if reader.peek() == ",":
+                reader.take(",")
+        reader.take("}")
+    elif char == "[":
+        reader.take("[")
+        position = 0
+        while reader.peek() != "]":
+            if reader.peek() == "{":
+                yield location, position, reader.value()
+            else:
+                yield from iter_json_records(reader, f"{location}[{position}]")
+            position += 1
+            if reader.peek() == ",":
+                reader.take(",")
+        reader.take("]")
+    else:
+        reader.value()
+
+
+def read_qms_records(path):
+    """Yield (key, location, record) for the records of a JSON document on disk."""
+    with open(path, encoding="utf-8") as f:
+        for location, position, record in iter_json_records(_JsonReader(f)):
+            record_id = _record_id(record, f"{location}[{position}]")
+            yield f"{location}:{record_id}", location, record
+
+
+def summarize_qms_schema(fields, counts):
+    return "\n".join(
+        f"- {location}: {counts[location]} records with fields {', '.join(counter)}"
+        for location, counter in fields.items()
+    )
+
+
+def retrieve_qms_records(path, query):
+    """Reduce a DTM/FMEA JSON document on disk to what matters for ``query``.
+
+    Returns (overview, records), where ``records`` maps record positions to
+    (location, record), most relevant first, or None if the document is to
+    be sent whole. The document is streamed twice, once for the schema,
+    record IDs and term statistics and once to score the records, keeping
+    only the best ones, so memory does not grow with the size of the records.
+    """
+    mode = os.environ.get("INPUT_QMS_CONTEXT_MODE") or "retrieval"
+    if mode == "full" or os.path.getsize(path) <= get_int_input(
+        "QMS_FULL_CONTEXT_CHARS", 20000
+    ):
+        return None
+
+    def query_term_counts(key, record):
+        tokens = tokenize(key) + tokenize(json.dumps(record))
+        return (
+            collections.Counter(token for token in tokens if token in query_terms),
+            len(tokens),
+        )
+
+    query_terms = set(tokenize(query))
+    fields = collections.OrderedDict()
+    counts = collections.Counter()
+    record_ids = []
+    doc_freq = collections.Counter()
+    total_length = 0
+    try:
+        for key, location, record in read_qms_records(path):
+            terms, length = query_term_counts(key, record)
+            doc_freq.update(terms.keys())
+            total_length += length
+            fields.setdefault(location, collections.Counter()).update(record.keys())
+            counts[location] += 1
+            record_ids.append(key.rsplit(":", 1)[1])
+    except ValueError:
+        record_ids = []
+    if not record_ids:
         return None
 
+    top_k = get_int_input("QMS_RECORDS", 15)
+    avg_length = total_length / len(record_ids) or 1
+    best = []
+    quoted = []
+    for position, (key, location, record) in enumerate(read_qms_records(path)):
+        terms, length = query_term_counts(key, record)
+        score = bm25_score(terms, length, doc_freq, len(record_ids), avg_length)
+        if score > 0:
+            heapq.heappush(best, (score, -position, location, record))
+            if len(best) > top_k:
+                heapq.heappop(best)
+        # Records whose ID is quoted in the issue are always relevant
+        record_id = record_ids[position]
+        if record_id in query and re.search(rf"\b{re.escape(record_id)}\b", query):
+            quoted.append((position, location, record))
+
+    # Quoted records first, then the best scoring
+    selected = {position: (location, record) for position, location, record in quoted}
+    for _, neg_position, location, record in sorted(best, reverse=True):
+        selected.setdefault(-neg_position, (location, record))
+    print(f"Selected {len(selected)} of {len(record_ids)} records for the prompt")
+    overview = (
+        f"Schema summary:\n{summarize_qms_schema(fields, counts)}\n\n"
+        f"All record IDs: {', '.join(record_ids)}"
+    )
+    return overview, selected
+
+
+def format_qms_records(overview, records):
+    relevant = {}
+    for position in sorted(records):
+        location, record = records[position]
+        relevant.setdefault(location, []).append(record)
+    return (
+        f"{overview}\n\n"
+        f"Entries relevant to this issue (other entries are omitted):\n"
+        f"{json.dumps(relevant, indent=2)}"
+    )
+
 
-def propose_design_matrix_updates(design_matrix_content, issue_body):
+def fit_qms_proposal_prompt(route, path, issue_body, build):
+    """Fit ``build(document_context, issue_body)`` to the budget of ``route``.
+
+    The least relevant records are dropped first.
+    """
+    retrieved = retrieve_qms_records(path, issue_body)
+    if retrieved is None:
+        with open(path, encoding="utf-8") as f:
+            document = f.read()
+        return fit_prompt(
+            route, lambda _, body: build(document, body), issue_body=issue_body
+        )
+    overview, records = retrieved
+    return fit_prompt(
+        route,
+        lambda records, body: build(format_qms_records(overview, records), body),
+        records,
+        issue_body,
+        keep_files=0,
+    )
+
+
+@stage("llm DTM proposal")
+def propose_design_matrix_updates(design_matrix_path, issue_body):
     client = get_openai_client()
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[
+
+    def build(design_matrix_content, body):
+        return [
             {
                 "role": "system",
                 "content": (
@@ -463,19 +2790,27 @@ def propose_design_matrix_updates(design_matrix_content, issue_body):
             },
             {
                 "role": "user",
-                "content": f"Current DTM content:\n{design_matrix_content}\n\nIssue description:\n{issue_body}\n\n Analyze if any updates are needed to the DTM based on this issue.",
+                "content": f"Current DTM content:\n{design_matrix_content}\n\nIssue description:\n{body}\n\n Analyze if any updates are needed to the DTM based on this issue.",
             },
-        ],
+        ]
+
+    response = client.chat.completions.create(
+        model=get_model("DTM proposal"),
+        messages=fit_qms_proposal_prompt(
+            "DTM proposal", design_matrix_path, issue_body, build
+        ),
         temperature=0.2,
     )
+    record_usage(response.usage, response.model)
     return response.choices[0].message.content
 
 
-def propose_fmea_updates(fmea_content, issue_body):
+@stage("llm FMEA proposal")
+def propose_fmea_updates(fmea_path, issue_body):
     client = get_openai_client()
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[
+
+    def build(fmea_content, body):
+        return [
             {
                 "role": "system",
                 "content": (
@@ -492,80 +2827,340 @@ def propose_fmea_updates(fmea_content, issue_body):
             },
             {
                 "role": "user",
-                "content": f"Current FMEA content:\n{fmea_content}\n\nIssue description:\n{issue_body}\n\nAnalyze if any updates are needed to the FMEA based on this issue.  ",
+                "content": f"Current FMEA content:\n{fmea_content}\n\nIssue description:\n{body}\n\nAnalyze if any updates are needed to the FMEA based on this issue.  ",
             },
-        ],
+        ]
+
+    response = client.chat.completions.create(
+        model=get_model("FMEA proposal"),
+        messages=fit_qms_proposal_prompt("FMEA proposal", fmea_path, issue_body, build),
         temperature=0.2,
     )
+    record_usage(response.usage, response.model)
     return response.choices[0].message.content
 
 
-def update_issue_section(issue_url, section_to_update, updates):
-    g = get_github_current_client()
-    # Handle both API URLs and web URLs
-    if "api.github.com" in issue_url:
+_issue_edit_lock = threading.Lock()
+
+
+def parse_issue_url(issue_url):
+    """Return (repo full name, issue number) for an API or web issue URL."""
+    if "/repos/" in issue_url:
         # API URL format: https://api.github.com/repos/owner/repo/issues/number
         parts = issue_url.split("/repos/")[1].split("/")
-        repo_name = f"{parts[0]}/{parts[1]}"
-        issue_number = int(parts[3])
-    else:
-        # Web URL format: https://github.com/owner/repo/issues/number
-        repo_name = "/".join(issue_url.split("/")[-4:-2])
-        issue_number = int(issue_url.split("/")[-1])
+        return f"{parts[0]}/{parts[1]}", int(parts[3])
+    # Web URL format: https://github.com/owner/repo/issues/number
+    return "/".join(issue_url.split("/")[-4:-2]), int(issue_url.split("/")[-1])
+
+
+def replace_issue_sections(issue_body, updates):
+    """Put each update between its <!--section--> tags; returns (body, written)."""
+    written = []
+    for section, content in updates.items():
+        section_start = f"<!--{section}-->"
+        section_end = f"<!--/{section}-->"
+        if section_start not in issue_body or section_end not in issue_body:
+            print(f"Error: Could not find the {section} section in the issue body.")
+            continue
+        start_index = issue_body.index(section_start) + len(section_start)
+        end_index = issue_body.index(section_end)
+        issue_body = issue_body[:start_index] + content + issue_body[end_index:]
+        written.append(section)
+    return issue_body, written
+
+
+@stage("issue edit")
+def update_issue_sections(issue_url, updates):
+    """Write several sections of an issue body in one edit.
+
+    ``updates`` maps section names to their new content. Right before writing,
+    a conditional request checks that nobody edited the issue since it was
+    read; if someone did, the sections are applied again to the fresh body.
+    Returns the names of the sections that were written.
+    """
+    repo_name, issue_number = parse_issue_url(issue_url)
+    repo = get_github_current_client().get_repo(repo_name)
+    attempts = get_int_input("ISSUE_EDIT_RETRIES", 3) + 1
+    # Jobs in the batch worker may edit the same issue
+    with _issue_edit_lock:
+        issue = repo.get_issue(issue_number)
+        read_at = issue.updated_at
+        for attempt in range(1, attempts + 1):
+            new_issue_body, written = replace_issue_sections(issue.body or "", updates)
+            if not written:
+                return written
+            # A 304 here means the issue is unchanged and costs no rate limit
+            if issue.update() and issue.updated_at != read_at:
+                read_at = issue.updated_at
+                print(
+                    f"Issue changed while it was being edited "
+                    f"(attempt {attempt}/{attempts}), applying the sections again"
+                )
+                continue
+            issue.edit(body=new_issue_body)
+            print(f"{', '.join(written)} section(s) updated in the issue.")
+            return written
+    raise RuntimeError(f"{issue_url} kept changing, sections were not written")
+
+
+def propose_dtm_section(docs_repo, issue_body):
+    design_matrix_path = get_qms_document_path(docs_repo, DESIGN_MATRIX_PATH)
+    # Cached documents are named by blob SHA, so equal documents share a proposal
+    design_matrix_updates = run_shared(
+        ("DTM proposal", os.path.basename(design_matrix_path), issue_body),
+        lambda: propose_design_matrix_updates(design_matrix_path, issue_body),
+    )
+    print("Design matrix updates: ", design_matrix_updates)
+    return design_matrix_updates
 
-    repo = g.get_repo(repo_name)
-    issue = repo.get_issue(issue_number)
-    issue_body = issue.body
 
-    section_start = f"<!--{section_to_update}-->"
-    section_end = f"<!--/{section_to_update}-->"
+def propose_fmea_section(docs_repo, issue_body):
+    fmea_path = get_qms_document_path(docs_repo, FMEA_PATH)
+    fmea_updates = run_shared(
+        ("FMEA proposal", os.path.basename(fmea_path), issue_body),
+        lambda: propose_fmea_updates(fmea_path, issue_body),
+    )
+    print("FMEA updates: ", fmea_updates)
+    return fmea_updates
 
-    if section_start in issue_body and section_end in issue_body:
-        start_index = issue_body.index(section_start) + len(section_start)
-        end_index = issue_body.index(section_end)
-        new_issue_body = (
-            issue_body[:start_index]  # Everything up to and including start tag
-            + updates  # New content between tags
-            + issue_body[end_index:]  # Everything from end tag onwards
-        )
 
-        issue.edit(body=new_issue_body)
-        print(f"{section_to_update} section updated in the issue.")
-    else:
-        print(
-            f"Error: Could not find the {section_to_update} section in the issue body."
-        )
+# Speculative prefetch. The reads each option starts with are issued while the
+# instruction is still being classified; they land in the snapshot and blob
+# caches, so the chosen option finds them there and the rest go unused.
+def _prefetch_listing(target_repo):
+    list_repo_files(get_github_qms_client().get_repo(target_repo))
 
 
-def main():
-    try:
-        target_repo = os.environ["INPUT_TARGET_REPO"]
-        instruction = os.environ["INPUT_INSTRUCTION"]
-
-        options = {
-            0: "No clear instruction",
-            1: "Create a change control record",
-            2: "Update change control record",
-            3: "Propose Design Traceability Matrix and/or FMAE updates",
-        }
+def _prefetch_change_request_template(target_repo):
+    repo = get_github_qms_client().get_repo(target_repo)
+    template_file = find_change_request_template(list_repo_files(repo))
+    if template_file:
+        get_file_content(repo, template_file)
+
+
+def _prefetch_qms_document(docs_repo, file_path):
+    get_file_path(get_github_qms_client().get_repo(docs_repo), file_path)
 
-        option = analyze_instruction(instruction, options)
-        print(f"Option: {option}")
 
-        issue_title = os.environ.get("INPUT_ISSUE_TITLE")
-        issue_body = os.environ.get("INPUT_ISSUE_BODY")
-        issue_url = os.environ.get("INPUT_ISSUE_URL")
-        pr_title = os.environ.get("INPUT_PR_TITLE")
-        pr_body = os.environ.get("INPUT_PR_BODY")
-        pr_url = os.environ.get("INPUT_PR_URL")
+def start_prefetch(target_repos, instruction, options):
+    """Start background reads for every option; returns (executor, futures).
+
+    ``futures`` maps each option to the reads it depends on.
+    """
+    if (os.environ.get("INPUT_PREFETCH") or "true").lower() != "true":
+        return None, {}
+    # Without a model call there is no classification latency to hide
+    if match_instruction(instruction, options) is not None or os.path.isfile(
+        _classification_cache_path(instruction, options)
+    ):
+        return None, {}
+
+    executor = ThreadPoolExecutor(max_workers=get_int_input("PREFETCH_WORKERS", 4))
+
+    def submit(task):
+        def run():
+            with stage("prefetch"):
+                return task()
+
+        return executor.submit(contextvars.copy_context().run, run)
+
+    listings = [
+        submit(lambda repo=repo: _prefetch_listing(repo)) for repo in target_repos
+    ]
+    # After the listing, so its repo and tree reads are served from the cache;
+    # it was submitted first, so it is running by the time this starts
+    template = submit(
+        lambda: (
+            listings[0].result(),
+            _prefetch_change_request_template(target_repos[0]),
+        )
+    )
+    documents = [
+        submit(lambda repo=repo, path=path: _prefetch_qms_document(repo, path))
+        for repo in dict.fromkeys(get_qms_docs_repo(repo) for repo in target_repos)
+        for path in (DESIGN_MATRIX_PATH, FMEA_PATH)
+    ]
+    return executor, {0: listings, 1: [listings[0], template], 3: documents}
+
+
+def finish_prefetch(prefetch, option):
+    """Wait for the reads ``option`` needs and drop the ones not yet started."""
+    executor, futures = prefetch
+    if executor is None:
+        return
+    wait(futures.get(option, []))
+    for future in futures.get(option, []):
+        # The option's own read reports the error if it happens again
+        if future.exception() is not None:
+            print(f"Prefetch failed: {future.exception()}")
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+JOB_FIELDS = (
+    "target_repo",
+    "instruction",
+    "issue_title",
+    "issue_body",
+    "issue_url",
+    "pr_title",
+    "pr_body",
+    "pr_url",
+)
+
+
+def parse_target_repos(value):
+    """Split a comma or newline separated list of ``owner/repo`` names."""
+    if isinstance(value, str):
+        value = re.split(r"[,\s]+", value)
+    return list(dict.fromkeys(repo.strip() for repo in value if repo.strip()))
+
+
+def combine_repo_results(outcomes):
+    """Merge per-repository (result, succeeded) pairs into one job result.
+
+    A single repository keeps its plain result; several are reported as a
+    JSON map from repository to result.
+    """
+    if len(outcomes) == 1:
+        return next(iter(outcomes.values()))
+    return (
+        json.dumps({repo: result for repo, (result, _) in outcomes.items()}),
+        all(succeeded for _, succeeded in outcomes.values()),
+    )
+
+
+def run_qms_update(
+    target_repo, instruction, issue_title, issue_body, issue_url, pr_title
+):
+    """Handle the QMS update for one repository; returns (result, succeeded)."""
+    qms_pr_url = None
+    if issue_title and not pr_title:
+        # Just an issue present, no PR yet
+        qms_pr_url = update_qms(
+            target_repo,
+            instruction,
+            issue_title,
+            issue_body,
+            issue_url,
+        )
+    elif issue_title and pr_title:
+        # Issue and PR present; with several repos the issue lists one PR each
+        qms_pr_url = next(
+            (
+                url
+                for url in re.findall(
+                    r"<qms_pr_creation>(.*?)</qms_pr_creation>", issue_body
+                )
+                if f"/{target_repo.lower()}/pull/" in url.lower()
+            ),
+            None,
+        )
+        if qms_pr_url:
+            # Extract the branch name from the PR URL
+            branch_name = qms_pr_url.split("/")[-2]
 
-        if option == 1:
+            # Update the existing PR
             g = get_github_qms_client()
             repo = g.get_repo(target_repo)
+            pr = repo.get_pull(int(qms_pr_url.split("/")[-1]))
+
+            # Logic of updating the PR
+
+        else:
+            print(f"Error: Could not find {target_repo} QMS PR URL in the issue body")
+            qms_pr_url = None
+
+    if qms_pr_url:
+        print(f"Pull request created: {qms_pr_url}")
+        return f"<qms_pr_creation>{qms_pr_url}</qms_pr_creation>", True
+    else:
+        return "No pull request created.", True
+
+
+def _qms_sections_result(succeeded, total):
+    if len(succeeded) == total:
+        return "DTM and FMEA updates added to the issue", True
+    elif succeeded:
+        return f"{succeeded[0]} updates added to the issue", False
+    else:
+        return "No DTM or FMEA updates added.", False
+
+
+@stage("job")
+@request_cache()
+@shared_work()
+def run_job(job):
+    """Handle one instruction; returns the action result and whether it succeeded."""
+    target_repos = parse_target_repos(job["target_repo"])
+    target_repo = target_repos[0]
+    instruction = job["instruction"]
+
+    options = {
+        0: "No clear instruction",
+        1: "Create a change control record",
+        2: "Update change control record",
+        3: "Propose Design Traceability Matrix and/or FMAE updates",
+    }
+
+    prefetch = start_prefetch(target_repos, instruction, options)
+    try:
+        option = analyze_instruction(instruction, options)
+    except Exception:
+        finish_prefetch(prefetch, None)
+        raise
+    finish_prefetch(prefetch, option)
+    print(f"Option: {option}")
+
+    issue_title = job.get("issue_title")
+    issue_body = job.get("issue_body")
+    issue_url = job.get("issue_url")
+    pr_title = job.get("pr_title")
+    pr_body = job.get("pr_body")
+    pr_url = job.get("pr_url")
+
+    if option in (1, 2) and len(target_repos) > 1:
+        print(f"Change control records are kept in {target_repo} only")
+
+    if option == 1:
+        g = get_github_qms_client()
+        repo = g.get_repo(target_repo)
+
+        cr_result = create_change_control_record(
+            repo,
+            instruction,
+            issue_title,
+            issue_body,
+            issue_url,
+            pr_title,
+            pr_body,
+            pr_url,
+        )
 
-            cr_result = create_change_control_record(
+        if cr_result:
+            filename, content, summary = cr_result
+            pr_url = create_pr_for_change_control(repo, filename, content, summary)
+
+            if pr_url:
+                print(f"Change Control Record PR created: {pr_url}")
+                return f"<change_control_pr>{pr_url}</change_control_pr>", True
+            else:
+                print("Failed to create Change Control Record PR")
+                return "No Change Control Record PR created.", True
+        else:
+            print("Failed to create Change Control Record")
+            return "No Change Control Record created.", True
+    elif option == 2:
+
+        g = get_github_qms_client()
+        repo = g.get_repo(target_repo)
+        cc_pr_url_match = re.search(
+            r"<change_control_pr>(.*?)</change_control_pr>", issue_body
+        )
+        if cc_pr_url_match:
+            cc_pr_url = cc_pr_url_match.group(1)
+            updated_pr_url = update_change_control_record(
                 repo,
-                instruction,
+                cc_pr_url,
                 issue_title,
                 issue_body,
                 issue_url,
@@ -574,123 +3169,261 @@ def main():
                 pr_url,
             )
 
-            if cr_result:
-                filename, content, summary = cr_result
-                pr_url = create_pr_for_change_control(repo, filename, content, summary)
-
-                if pr_url:
-                    print(f"Change Control Record PR created: {pr_url}")
-                    print(
-                        f"::set-output name=result::<change_control_pr>{pr_url}</change_control_pr>"
-                    )
-                else:
-                    print("Failed to create Change Control Record PR")
-                    print(
-                        "::set-output name=result::No Change Control Record PR created."
-                    )
+            if updated_pr_url:
+                print(f"Change Control Record updated: {updated_pr_url}")
+                return (
+                    f"<change_control_pr_updated>{updated_pr_url}</change_control_pr_updated>",
+                    True,
+                )
             else:
-                print("Failed to create Change Control Record")
-                print("::set-output name=result::No Change Control Record created.")
-        elif option == 2:
-
-            g = get_github_qms_client()
-            repo = g.get_repo(target_repo)
-            cc_pr_url_match = re.search(
-                r"<change_control_pr>(.*?)</change_control_pr>", issue_body
+                print("Failed to update Change Control Record")
+                return "No Change Control Record updated.", True
+        else:
+            print(
+                "Error: Could not find Change Control Record PR URL in the issue body"
             )
-            if cc_pr_url_match:
-                cc_pr_url = cc_pr_url_match.group(1)
-                updated_pr_url = update_change_control_record(
-                    repo,
-                    cc_pr_url,
-                    issue_title,
-                    issue_body,
-                    issue_url,
-                    pr_title,
-                    pr_body,
-                    pr_url,
-                )
-
-                if updated_pr_url:
-                    print(f"Change Control Record updated: {updated_pr_url}")
-                    print(
-                        f"::set-output name=result::<change_control_pr_updated>{updated_pr_url}</change_control_pr_updated>"
-                    )
-                else:
-                    print("Failed to update Change Control Record")
-                    print("::set-output name=result::No Change Control Record updated.")
+            return (
+                "No Change Control Record updated, because no PR URL was found.",
+                True,
+            )
+    elif option == 3:
+        print("Propose Design Traceability Matrix and/or FMAE updates")
+        # The DTM and FMEA chains are independent, also between docs repos;
+        # run them side by side so one failing chain does not keep the
+        # others out of the issue.
+        pipelines = {
+            "DTM": ("qms-section:dtm", propose_dtm_section),
+            "FMEA": ("qms-section:fmea", propose_fmea_section),
+        }
+        docs_repos = {repo: get_qms_docs_repo(repo) for repo in target_repos}
+        sources = list(dict.fromkeys(docs_repos.values()))
+        tasks = [(name, source) for source in sources for name in pipelines]
+        results = run_concurrently(
+            [
+                lambda name=name, source=source: pipelines[name][1](source, issue_body)
+                for name, source in tasks
+            ],
+            get_int_input("REPO_WORKERS", 4) * len(pipelines),
+        )
+        proposals = {name: {} for name in pipelines}
+        for (name, source), (content, error) in zip(tasks, results):
+            if error is not None:
+                print(f"Error: {name} proposal for {source} failed. Exception: {error}")
             else:
-                print(
-                    "Error: Could not find Change Control Record PR URL in the issue body"
+                proposals[name][source] = content
+
+        # All sections go into the issue with a single edit, one block per
+        # docs repo when there are several
+        updates = {}
+        for name, (section, _) in pipelines.items():
+            if len(sources) == 1:
+                if sources[0] in proposals[name]:
+                    updates[section] = proposals[name][sources[0]]
+            elif proposals[name]:
+                updates[section] = "\n\n".join(
+                    f"#### {source}\n{content}"
+                    for source, content in proposals[name].items()
                 )
-                print(
-                    "::set-output name=result::No Change Control Record updated, because no PR URL was found."
+        written = []
+        if updates:
+            try:
+                written = update_issue_sections(issue_url, updates)
+            except Exception as e:
+                print(f"Error: Could not update the issue. Exception: {e}")
+
+        return combine_repo_results(
+            {
+                repo: _qms_sections_result(
+                    [
+                        name
+                        for name, (section, _) in pipelines.items()
+                        if section in written and docs_repos[repo] in proposals[name]
+                    ],
+                    len(pipelines),
+                )
+                for repo in target_repos
+            }
+        )
+    else:
+        # Repositories are updated side by side; classification above and
+        # any work with identical inputs is shared between them
+        results = run_concurrently(
+            [
+                lambda repo=repo: run_qms_update(
+                    repo, instruction, issue_title, issue_body, issue_url, pr_title
                 )
-        elif option == 3:
-            print("Propose Design Traceability Matrix and/or FMAE updates")
-            design_matrix_content = get_design_matrix_content()
-            design_matrix_updates = propose_design_matrix_updates(
-                design_matrix_content, issue_body
+                for repo in target_repos
+            ],
+            get_int_input("REPO_WORKERS", 4),
+        )
+        outcomes = {}
+        for repo, (outcome, error) in zip(target_repos, results):
+            if error is not None:
+                if len(target_repos) == 1:
+                    raise error
+                print(f"Error: {repo} update failed. Exception: {error}")
+                outcome = f"Update failed: {error}", False
+            outcomes[repo] = outcome
+        return combine_repo_results(outcomes)
+
+
+# Batch worker mode. Jobs are JSON files with the JOB_FIELDS keys dropped into
+# a queue directory. A job is claimed by renaming it to .running and moved to
+# done/ with its result, so a restarted worker picks up where it stopped.
+def _requeue_interrupted_jobs(queue_dir):
+    for name in os.listdir(queue_dir):
+        if name.endswith(".running"):
+            os.replace(
+                os.path.join(queue_dir, name),
+                os.path.join(queue_dir, name[: -len(".running")] + ".json"),
             )
-            print("Design matrix updates: ", design_matrix_updates)
+            print(f"Requeued interrupted job {name}")
+
+
+def _claim_job(queue_dir):
+    for name in sorted(os.listdir(queue_dir)):
+        if not name.endswith(".json") or name == "checkpoint.json":
+            continue
+        path = os.path.join(queue_dir, name)
+        running_path = path[: -len(".json")] + ".running"
+        try:
+            os.rename(path, running_path)
+        except FileNotFoundError:
+            continue  # Claimed by another worker
+        return running_path
+    return None
+
+
+def _process_job(queue_dir, running_path):
+    name = os.path.basename(running_path)[: -len(".running")]
+    print(f"Job {name}: started")
+    job = None
+    try:
+        with open(running_path) as f:
+            job = json.load(f)
+        result, succeeded = run_job(job)
+    except Exception as e:
+        # Unreadable jobs are moved to done/ too, or they would be requeued
+        result, succeeded = f"Job failed: {e}", False
+    print(f"Job {name}: {result}")
+
+    done_dir = os.path.join(queue_dir, "done")
+    os.makedirs(done_dir, exist_ok=True)
+    with open(os.path.join(done_dir, f"{name}.json"), "w") as f:
+        json.dump(
+            {
+                "job": job,
+                "result": result,
+                "succeeded": succeeded,
+                "finished_at": datetime.datetime.now().isoformat(),
+            },
+            f,
+        )
+    os.remove(running_path)
+    return succeeded
 
-            update_issue_section(issue_url, "qms-section:dtm", design_matrix_updates)
 
-            print("Design matrix updates added to the issue")
+def _job_succeeded(future, running_path):
+    # A job that could not even be recorded must not stop the worker
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"Job {os.path.basename(running_path)}: could not be processed: {e}")
+        return False
 
-            fmea_content = get_fmea_content()
-            print("FMEA content: ", fmea_content)
-            fmea_updates = propose_fmea_updates(fmea_content, issue_body)
-            print("FMEA updates: ", fmea_updates)
 
-            update_issue_section(issue_url, "qms-section:fmea", fmea_updates)
+def _write_checkpoint(queue_dir, running, completed, failed):
+    with open(os.path.join(queue_dir, "checkpoint.json"), "w") as f:
+        json.dump(
+            {
+                "completed": completed,
+                "failed": failed,
+                "running": sorted(os.path.basename(path) for path in running),
+                "written_at": datetime.datetime.now().isoformat(),
+            },
+            f,
+        )
+
 
-            print("FMEA updates added to the issue")
-            print(f"::set-output name=result::DTM and FMEA updates added to the issue")
-        else:
-            if issue_title and not pr_title:
-                # Just an issue present, no PR yet
-                qms_pr_url = update_qms(
-                    target_repo,
-                    instruction,
-                    issue_title,
-                    issue_body,
-                    issue_url,
-                )
-            elif issue_title and pr_title:
-                # Issue and PR present
-                qms_pr_url_match = re.search(
-                    r"<qms_pr_creation>(.*?)</qms_pr_creation>", issue_body
-                )
-                if qms_pr_url_match:
-                    qms_pr_url = qms_pr_url_match.group(1)
-                    # Extract the branch name from the PR URL
-                    branch_name = qms_pr_url.split("/")[-2]
+def run_worker(queue_dir):
+    """Process queued jobs until SIGTERM/SIGINT, reusing clients and caches."""
+    os.makedirs(queue_dir, exist_ok=True)
+    _requeue_interrupted_jobs(queue_dir)
+    stop = threading.Event()
 
-                    # Update the existing PR
-                    g = get_github_qms_client()
-                    repo = g.get_repo(target_repo)
-                    pr = repo.get_pull(int(qms_pr_url.split("/")[-1]))
+    def request_stop(signum, frame):
+        print(f"Received signal {signum}, finishing running jobs")
+        stop.set()
 
-                    # Logic of updating the PR
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
 
+    workers = get_int_input("WORKER_JOBS", 2)
+    poll_interval = get_int_input("WORKER_POLL_INTERVAL", 5)
+    exit_when_empty = (os.environ.get("INPUT_WORKER_EXIT_WHEN_EMPTY") or "").lower()
+    running = {}
+    completed = failed = 0
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while not stop.is_set():
+            for future in [future for future in running if future.done()]:
+                running_path = running.pop(future)
+                if _job_succeeded(future, running_path):
+                    completed += 1
                 else:
-                    print("Error: Could not find QMS PR URL in the issue body")
-                    qms_pr_url = None
-
-            if qms_pr_url:
-                print(f"Pull request created: {qms_pr_url}")
-                print(
-                    f"::set-output name=result::<qms_pr_creation>{qms_pr_url}</qms_pr_creation>"
+                    failed += 1
+            while len(running) < workers:
+                running_path = _claim_job(queue_dir)
+                if running_path is None:
+                    break
+                running[executor.submit(_process_job, queue_dir, running_path)] = (
+                    running_path
                 )
-            else:
-                print(f"::set-output name=result::No pull request created.")
+            _write_checkpoint(queue_dir, running.values(), completed, failed)
+            if not running and exit_when_empty == "true":
+                break
+            stop.wait(poll_interval)
+    finally:
+        # Jobs that do not finish within the grace period stay .running and
+        # are requeued by the next worker
+        done, not_done = wait(running, timeout=get_int_input("WORKER_GRACE_PERIOD", 60))
+        succeeded = [_job_succeeded(future, running[future]) for future in done]
+        completed += sum(succeeded)
+        failed += len(succeeded) - sum(succeeded)
+        _write_checkpoint(
+            queue_dir, [running[future] for future in not_done], completed, failed
+        )
+        executor.shutdown(wait=False)
+        print(f"Worker stopped: {completed} jobs completed, {failed} failed")
+        report_metrics()
+        if not_done:
+            # os._exit skips flushing, and stdout is block-buffered in containers
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(1)
+
+
+def main():
+    if os.environ.get("INPUT_WORKER_QUEUE"):
+        run_worker(os.environ["INPUT_WORKER_QUEUE"])
+        return
+
+    try:
+        job = {field: os.environ.get(f"INPUT_{field.upper()}") for field in JOB_FIELDS}
+        job["target_repo"] = os.environ["INPUT_TARGET_REPO"]
+        job["instruction"] = os.environ["INPUT_INSTRUCTION"]
+        result, succeeded = run_job(job)
+        print(f"::set-output name=result::{result}")
+        if not succeeded:
+            sys.exit(1)
     except KeyError as e:
         print(f"Error: Missing environment variable {e}")
         sys.exit(1)
     except ValueError:
         print("Error: Please provide a valid integer as input.")
         sys.exit(1)
+    finally:
+        report_metrics()
 
 
 if __name__ == "__main__":